@@ -0,0 +1,75 @@
+"""
+Side-by-side benchmark of the WSGI app (create_app on gunicorn) and the
+ASGI app (create_async_app on hypercorn) against the same database.
+
+From the backend folder:
+
+    python benchmarks/async_vs_sync.py --workers 2 --concurrency 500 --duration 15
+
+Both servers are started with the same number of worker processes, one
+after the other, and driven with the same mix of requests.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import loadgen
+
+REQUESTS = [
+    ("GET", "/questions?page=1", None),
+    ("GET", "/categories", None),
+    ("GET", "/categories/1/questions", None),
+    ("POST", "/quizzes", {"previous_questions": [], "quiz_category": {"type": "click", "id": 0}}),
+    ("POST", "/questions", {"searchTerm": "the"}),
+]
+
+SERVERS = {
+    "sync": ["gunicorn", "--workers", "{workers}", "--bind", "127.0.0.1:{port}", "flaskr:create_app()"],
+    "async": ["hypercorn", "--workers", "{workers}", "--bind", "127.0.0.1:{port}", "flaskr.asgi:create_async_app()"],
+}
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start on port {}".format(port))
+
+def bench(name, args):
+    command = [part.format(workers=args.workers, port=args.port) for part in SERVERS[name]]
+    # The benchmarks measure the servers, not the rate limiter
+    env = dict(os.environ, FLASK_ADMISSION_RATE="0")
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.port)
+        url = "http://127.0.0.1:{}".format(args.port)
+        loadgen.run(url, REQUESTS, min(args.concurrency, 10), 2)  # warm up
+        return loadgen.run(url, REQUESTS, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    results = {name: bench(name, args) for name in ("sync", "async")}
+    print(json.dumps(results, indent=2))
+    if results["sync"]["rps"]:
+        print("async/sync throughput: {:.2f}x".format(results["async"]["rps"] / results["sync"]["rps"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+"""
+A small HTTP/1.1 load generator on asyncio streams, so that thousands of
+concurrent keep-alive clients fit in one process without extra packages.
+"""
+
+"""
+percentile(latencies, p)
+    the p-th percentile of a sorted list of latencies
+"""
+def percentile(latencies, p):
+    if not latencies:
+        return 0.0
+    index = min(int(len(latencies) * p / 100), len(latencies) - 1)
+    return latencies[index]
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+async def _request(reader, writer, host, method, path, body):
+    payload = json.dumps(body).encode() if body is not None else b""
+    head = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n".format(method, path, host)
+    if body is not None:
+        head += "Content-Type: application/json\r\n"
+    head += "Content-Length: {}\r\n\r\n".format(len(payload))
+    writer.write(head.encode() + payload)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    keep_alive = status_line.startswith(b"HTTP/1.1")
+    length = 0
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+        elif name.lower() == "transfer-encoding" and "chunked" in value.lower():
+            chunked = True
+        elif name.lower() == "connection":
+            keep_alive = value.strip().lower() == "keep-alive"
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+async def _client(url, next_request, deadline, latencies, counters):
+    parts = urlsplit(url)
+    reader = writer = None
+    while time.monotonic() < deadline:
+        request = next_request()
+        if request is None:
+            break
+        method, path, body = request
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            started = time.perf_counter()
+            status, keep_alive = await _request(reader, writer, parts.netloc, method, path, body)
+            latencies.append(time.perf_counter() - started)
+            if not keep_alive:
+                writer.close()
+                reader = writer = None
+            if status >= 500 or status == 429:
+                counters["errors"] += 1
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            counters["errors"] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+def _cycling(requests):
+    index = 0
+    def next_request():
+        nonlocal index
+        index += 1
+        return requests[(index - 1) % len(requests)]
+    return next_request
+
+"""
+run(url, requests, concurrency, duration, cycle)
+    drives concurrency keep-alive clients cycling through requests, a list
+    of (method, path, json body or None), against url for duration seconds
+    and returns the request count, error count, requests per second and
+    the p50/p95/p99 latencies in milliseconds.
+    With cycle=False each request is sent once, by any of the clients,
+    and the run ends early when they are all sent.
+"""
+def run(url, requests, concurrency=50, duration=10.0, cycle=True):
+    async def main():
+        latencies = []
+        counters = {"errors": 0}
+        deadline = time.monotonic() + duration
+        started = time.monotonic()
+        if cycle:
+            clients = [_cycling(requests[offset:] + requests[:offset])
+                       for offset in (i % len(requests) for i in range(concurrency))]
+        else:
+            remaining = iter(requests)
+            clients = [lambda: next(remaining, None)] * concurrency
+        await asyncio.gather(*[_client(url, next_request, deadline, latencies, counters)
+                               for next_request in clients])
+        return summarize(latencies, counters["errors"], time.monotonic() - started)
+    return asyncio.run(main())
@@ -0,0 +1,65 @@
+"""
+CPU cost of writing a page of questions as JSON: Question objects with
+format() and jsonify, against QUESTION_COLUMNS rows with the row writer
+of QuestionJSONProvider. Both bodies are checked to be the same bytes.
+
+From the backend folder:
+
+    python benchmarks/serialization.py --database-url sqlite:////tmp/trivia_bench.db --sizes 10 100 1000
+
+The database needs at least the largest page size of questions, e.g.
+seeded by benchmarks/suite.py.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def measure(function, iterations):
+    started = time.process_time()
+    for _ in range(iterations):
+        body = function()
+    return (time.process_time() - started) / iterations, body
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    from flask import jsonify
+    from flaskr import create_app
+    from flaskr.serialization import QUESTION_COLUMNS, QuestionRows
+    from models import Question
+
+    config = {"SQLALCHEMY_DATABASE_URI": args.database_url} if args.database_url else {}
+    config["INSTRUMENTATION"] = False
+    app = create_app(config)
+    results = {}
+    with app.test_request_context():
+        for size in args.sizes:
+            def orm():
+                selection = Question.query.order_by(Question.id).limit(size).all()
+                return jsonify({"success": True, "questions": [question.format() for question in selection]}).get_data()
+
+            def rows():
+                selection = Question.query.with_entities(*QUESTION_COLUMNS).order_by(Question.id).limit(size).all()
+                return jsonify({"success": True, "questions": QuestionRows(selection)}).get_data()
+
+            orm_seconds, orm_body = measure(orm, args.iterations)
+            rows_seconds, rows_body = measure(rows, args.iterations)
+            if orm_body != rows_body:
+                sys.exit("the bodies of a page of {} questions differ".format(size))
+            results[size] = {
+                "orm_format_us": round(orm_seconds * 1e6, 1),
+                "rows_writer_us": round(rows_seconds * 1e6, 1),
+                "speedup": round(orm_seconds / rows_seconds, 2) if rows_seconds else None,
+            }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Latency and throughput benchmarks of the trivia endpoints, on a synthetic
+question bank, with stored baselines to catch regressions.
+
+From the backend folder, against a local database:
+
+    python benchmarks/suite.py --database-url postgresql://localhost/trivia_bench --size 10000 --save
+    python benchmarks/suite.py --database-url postgresql://localhost/trivia_bench --size 10000 --compare
+
+The database is brought to --size questions first. Then each scenario
+is driven over HTTP with benchmarks/loadgen.py, against gunicorn started
+on the database, or against --url when a server is already running.
+--in-process runs the same scenarios through the Flask test client
+instead, which measures the app code without the server and the network.
+
+--save stores the results as the baseline of the size and mode, and
+--compare fails (exit status 1) when a scenario's p95 latency or
+throughput is worse than its baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import loadgen
+from benchmarks.async_vs_sync import wait_for_port
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+CATEGORIES = ["Science", "Art", "Geography", "History", "Entertainment", "Sports"]
+WORDS = ["river", "planet", "painter", "empire", "goal", "novel", "mountain", "atom",
+         "king", "movie", "ocean", "bridge", "poem", "comet", "temple", "medal"]
+SEARCH_TERM = "river"
+PREVIOUS_QUESTIONS = 1000
+DELETE_POOL = 20000
+
+"""
+synthetic_questions(count, categories, rng)
+    yields (line_number, record) for count generated questions, the input
+    of import_questions()
+"""
+def synthetic_questions(count, categories, rng):
+    for n in range(count):
+        words = rng.sample(WORDS, 3)
+        yield n + 1, {
+            "question": "Question {} about the {}, the {} and the {}?".format(n, *words),
+            "answer": rng.choice(WORDS),
+            "category": rng.choice(categories),
+            "difficulty": rng.randint(1, 5),
+        }
+
+"""
+seed(app, size)
+    brings the question bank to size questions, adding the categories if
+    there are none and removing the questions created by earlier runs,
+    and returns what the scenarios need to know about it
+"""
+def seed(app, size, rng):
+    from flaskr.bulk import import_questions
+    from models import db, notify_write, Category, Question, QuestionCount
+
+    with app.app_context():
+        if not Category.query.count():
+            for name in CATEGORIES:
+                Category(name).insert()
+        categories = [category_id for (category_id,) in db.session.query(Category.id).order_by(Category.id)]
+        missing = size - Question.query.count()
+        if missing > 0:
+            started = time.monotonic()
+            imported, failed, errors = import_questions(synthetic_questions(missing, categories, rng),
+                                                        set(categories))
+            print("seeded {} questions in {:.1f}s".format(imported, time.monotonic() - started), file=sys.stderr)
+        elif missing < 0:
+            cutoff = db.session.query(Question.id).order_by(Question.id).offset(size - 1).limit(1).scalar()
+            Question.query.filter(Question.id > cutoff).delete(synchronize_session=False)
+            QuestionCount.rebuild()
+            notify_write("questions", "bulk", [])
+        ids = [question_id for (question_id,) in db.session.query(Question.id).order_by(Question.id)]
+        category_ids = [question_id for (question_id,) in
+                        db.session.query(Question.id).filter(Question.category == categories[0])]
+    return {"categories": categories, "ids": ids, "category_ids": category_ids}
+
+"""
+create_pool(app, count, category, rng)
+    adds count questions to category for a scenario deleting them, and
+    returns their ids. The next seed() removes those left.
+"""
+def create_pool(app, count, category, rng):
+    from flaskr.bulk import import_questions
+    from models import db, Question
+
+    with app.app_context():
+        last_id = db.session.query(db.func.max(Question.id)).scalar() or 0
+        import_questions(synthetic_questions(count, [category], rng), {category})
+        return [question_id for (question_id,) in
+                db.session.query(Question.id).filter(Question.id > last_id).order_by(Question.id)]
+
+"""
+scenarios(bank, rng, pool)
+    name -> list of (method, path, json body or None) requests. The write
+    scenarios come last, so that the reads all see the seeded bank.
+    A scenario consuming rows is a function returning its requests, built
+    from a fresh pool() of ids right before it runs, each sent once.
+"""
+def scenarios(bank, rng, pool):
+    ids = bank["ids"]
+    category = bank["categories"][0]
+    last_page = max((len(ids) + 9) // 10, 1)
+    quiz = lambda category_id, previous: ("POST", "/quizzes", {
+        "previous_questions": previous, "quiz_category": {"type": "click", "id": category_id}})
+    return {
+        "questions_first_page": [("GET", "/questions?page=1", None)],
+        "questions_deep_page": [("GET", "/questions?page={}".format(last_page), None)],
+        "questions_deep_after_id": [("GET", "/questions?after_id={}".format(ids[-11] if len(ids) > 10 else 0), None)],
+        "categories": [("GET", "/categories", None)],
+        "category_questions": [("GET", "/categories/{}/questions".format(category), None)],
+        "search": [("POST", "/questions", {"searchTerm": SEARCH_TERM})],
+        "quiz": [quiz(0, [])],
+        "quiz_long_previous": [quiz(0, rng.sample(ids, min(PREVIOUS_QUESTIONS, len(ids))))],
+        "quiz_category_long_previous": [quiz(category, bank["category_ids"][:-1])],
+        "create_question": [("POST", "/questions", {
+            "question": "Benchmark question {}?".format(n), "answer": "answer",
+            "category": category, "difficulty": 1}) for n in range(100)],
+        # Questions added for it, each deleted once: not the bank, nor 422s
+        "delete_question": lambda: [("DELETE", "/questions/{}".format(question_id), None)
+                                    for question_id in pool()],
+    }
+
+"""
+run_in_process(app, requests, duration, cycle)
+    sends requests through the Flask test client for duration seconds, or
+    each once without cycle, and returns the same summary as loadgen.run()
+"""
+def run_in_process(app, requests, duration, cycle=True):
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    index = 0
+    started = time.monotonic()
+    deadline = started + duration
+    while time.monotonic() < deadline and (cycle or index < len(requests)):
+        method, path, body = requests[index % len(requests)]
+        index += 1
+        began = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        latencies.append(time.perf_counter() - began)
+        if response.status_code >= 500 or response.status_code == 429:
+            errors += 1
+    return loadgen.summarize(latencies, errors, time.monotonic() - started)
+
+"""
+compare(results, baseline, tolerance)
+    the regressions of results against a baseline, as messages
+"""
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if expected["p95_ms"] and result["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append("{}: p95 {} ms, baseline {} ms".format(name, result["p95_ms"], expected["p95_ms"]))
+        if expected["rps"] and result["rps"] < expected["rps"] * (1 - tolerance):
+            regressions.append("{}: {} requests/s, baseline {}".format(name, result["rps"], expected["rps"]))
+    return regressions
+
+def start_server(args):
+    env = dict(os.environ)
+    # The benchmarks measure the app, not the rate limiter
+    env["FLASK_ADMISSION_RATE"] = "0"
+    if args.database_url:
+        env["FLASK_SQLALCHEMY_DATABASE_URI"] = args.database_url
+    command = ["gunicorn", "--workers", str(args.workers), "--bind", "127.0.0.1:{}".format(args.port),
+               "flaskr:create_app()"]
+    server = subprocess.Popen(command, cwd=BACKEND, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(args.port)
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--size", type=int, default=10000, help="questions in the bank, e.g. 10000 or 1000000")
+    parser.add_argument("--scenario", action="append", help="run only these scenarios")
+    parser.add_argument("--url", help="a server already running on the database")
+    parser.add_argument("--in-process", action="store_true", help="use the Flask test client, no server")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--delete-pool", type=int, default=DELETE_POOL,
+                        help="questions added for the delete scenario, more than it can delete in --duration")
+    parser.add_argument("--baseline", help="defaults to benchmarks/baselines/<mode>-<size>.json")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="fail on a regression from the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    from flaskr import create_app
+    rng = random.Random(args.seed)
+    config = {"SQLALCHEMY_DATABASE_URI": args.database_url} if args.database_url else {}
+    config["ADMISSION_RATE"] = 0
+    app = create_app(config)
+    bank = seed(app, args.size, rng)
+    pool = lambda: create_pool(app, args.delete_pool, bank["categories"][0], rng)
+    selected = {name: requests for name, requests in scenarios(bank, rng, pool).items()
+                if not args.scenario or name in args.scenario}
+
+    mode = "in-process" if args.in_process else "http"
+    results = {}
+    server = None
+    try:
+        if not args.in_process and not args.url:
+            server = start_server(args)
+        url = args.url or "http://127.0.0.1:{}".format(args.port)
+        for name, requests in selected.items():
+            cycle = not callable(requests)
+            if not cycle:
+                requests = requests()
+            if args.in_process:
+                results[name] = run_in_process(app, requests, args.duration, cycle)
+            else:
+                results[name] = loadgen.run(url, requests, args.concurrency, args.duration, cycle)
+            if not cycle and results[name]["requests"] >= len(requests):
+                print("{}: the pool of {} ran out before --duration, raise --delete-pool".format(
+                    name, len(requests)), file=sys.stderr)
+            print("{:<28} {:>9} rps  p50 {:>8} ms  p95 {:>8} ms  p99 {:>8} ms  {} errors".format(
+                name, results[name]["rps"], results[name]["p50_ms"], results[name]["p95_ms"],
+                results[name]["p99_ms"], results[name]["errors"]), file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps(results, indent=2))
+    baseline_path = args.baseline or os.path.join(BASELINES, "{}-{}.json".format(mode, args.size))
+    if args.save:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w") as output:
+            json.dump({"mode": mode, "size": args.size, "scenarios": results}, output, indent=2, sort_keys=True)
+        print("saved the baseline to {}".format(baseline_path), file=sys.stderr)
+    if args.compare:
+        with open(baseline_path) as baseline:
+            regressions = compare(results, json.load(baseline)["scenarios"], args.tolerance)
+        for regression in regressions:
+            print("regression: {}".format(regression), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
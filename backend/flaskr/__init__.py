@@ -1,31 +1,75 @@
+import time
+_import_started = time.perf_counter()
+
+import io
 import os
-import math
-from flask import Flask, request, abort, jsonify
+import click
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy import func
 import random
 
-from models import db, setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
-
-def paginated(request, selection):
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    total_pages = math.ceil(len(selection)/QUESTIONS_PER_PAGE)
+from models import db, setup_db, add_write_hook, pool_stats, Question, QuestionCount
+from migrations import MIGRATIONS, failed_versions, migrate, pending_migrations
+from .pagination import paginated
+from .search import SearchIndex
+from .sampling import QuestionSampler
+from .quiz_sessions import QuizSessions
+from .decks import MAX_PREFETCH, MODES as DECK_MODES, QuizDecks
+from .generations import GenerationCounter
+from .categories import CategoryCache
+from .metadata import SharedMetadata
+from .cache import ResponseCache
+from .admission import AdmissionControl
+from .counts import QuestionTotals
+from .instrumentation import Instrumentation
+from .serialization import QuestionJSONProvider
+from .streaming import STREAM_BATCH_SIZE, STREAM_FORMATS, question_rows, stream_questions
+from .bulk import BATCH_SIZE, export_questions, import_questions, read_csv, read_ndjson
+from .pipeline import WritePipeline
+from .batch import MAX_OPERATIONS, run_batch
+from .snapshot import build_snapshot, merge_journal, serve_snapshot
+from .startup import StartupTimings, warm_up
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-
-    return page, total_pages, current_questions
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    startup = app.extensions["trivia_startup"] = StartupTimings(IMPORT_SECONDS)
+    # Any config key can be set from the environment, e.g. FLASK_DB_POOL_SIZE=20
+    app.config.from_prefixed_env()
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    # A read-only app serving a snapshot file, without the database
+    if app.config.get("SNAPSHOT_PATH"):
+        return serve_snapshot(app)
+    startup.mark("config")
+    # LAZY_STARTUP: no database access until the first request, the
+    # schema left to `flask migrate` and the caches warmed in the background
+    lazy = app.config.get("LAZY_STARTUP", False)
+    if lazy:
+        app.config.setdefault("SCHEMA_MODE", "skip")
     setup_db(app)
+    startup.mark("database")
+    app.json = QuestionJSONProvider(app)
+    instrumentation = Instrumentation(app)
+
+    generations = GenerationCounter(app)
+    add_write_hook(app, generations.on_write)
+    # Shared by the workers of the host, SHARED_METADATA = False keeps a copy per worker
+    metadata = SharedMetadata(app, generations) if app.config.get("SHARED_METADATA", True) else None
+    category_cache = CategoryCache(generations, metadata)
+    response_cache = ResponseCache(app, generations)
+    admission = AdmissionControl(app, generations)
+    question_totals = QuestionTotals(app, generations)
+    search_index = SearchIndex(app, generations)
+    sampler = QuestionSampler(app, metadata)
+    quiz_sessions = QuizSessions(app, sampler, generations)
+    decks = QuizDecks(app, sampler)
+    # Optional: the question writes of the API committed in groups
+    write_pipeline = WritePipeline(app) if app.config.get("WRITE_PIPELINE") else None
+    startup.mark("components")
     
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -34,6 +78,8 @@ def create_app(test_config=None):
     """
     @TODO: Use the after_request decorator to set Access-Control-Allow
     """
+    app.before_request(startup.on_request)
+
     @app.after_request
     def after_request(response):
         response.headers.add(
@@ -51,18 +97,74 @@ def create_app(test_config=None):
     """
     @app.route("/categories")
     def get_categories():
-        # Query the categories
-        selection = Category.query.order_by(Category.id).all()
-        categories = {category.id: category.type for category in selection}
+        # Served from the category cache, without the database when fresh
+        categories, etag = category_cache.get()
         
         if len(categories) == 0:
             abort(404)
-        
+
+        # ?include=counts adds the question counters, which version the ETag
+        include_counts = request.args.get("include") == "counts"
+        last_modified = generations.modified_at("categories")
+        if include_counts:
+            etag = "{}-{}".format(etag, generations.version("questions"))
+            last_modified = max(last_modified, generations.modified_at("questions"))
+
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            body = {
+                "success": True,
+                "categories": categories,
+                "total_categories": len(categories)
+            }
+            if include_counts:
+                counts = question_totals.counts()
+                body["question_counts"] = {category_id: counts.get(category_id, 0) for category_id in categories}
+                body["total_questions"] = question_totals.get()
+            response = jsonify(body)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    @app.route("/metrics/pool")
+    def get_pool_stats():
         return jsonify({
             "success": True,
-            "categories": categories,
-            "total_categories": len(Category.query.all())
+            "engines": pool_stats(),
         })
+
+    @app.route("/metrics/admission")
+    def get_admission_stats():
+        stats = admission.stats()
+        stats["success"] = True
+        return jsonify(stats)
+
+    @app.route("/metrics/pipeline")
+    def get_pipeline_stats():
+        if write_pipeline is None:
+            abort(404)
+        stats = write_pipeline.stats()
+        stats["success"] = True
+        return jsonify(stats)
+
+    @app.route("/metrics/startup")
+    def get_startup_timings():
+        timings = startup.as_dict()
+        timings["success"] = True
+        return jsonify(timings)
+
+    @app.route("/metrics")
+    def get_metrics():
+        return app.response_class(
+            instrumentation.prometheus(pool=pool_stats(), cache=response_cache.stats()),
+            mimetype="text/plain; version=0.0.4")
+
+    @app.route("/cache/stats")
+    def get_cache_stats():
+        stats = response_cache.stats()
+        stats["success"] = True
+        return jsonify(stats)
     """
     @TODO:
     Create an endpoint to handle GET requests for questions,
@@ -76,22 +178,23 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     """
     @app.route("/questions")
+    @response_cache.cached("questions", "categories")
+    @admission.expensive("questions", "categories")
     def get_questions():
+        # ?stream=json or ?stream=ndjson streams all the questions, unpaginated
+        stream_format = request.args.get("stream")
+        if stream_format is not None and stream_format not in STREAM_FORMATS:
+            abort(400)
         try:
-            # Query the categories
-            categories = Category.query.order_by(Category.id).all()
-            formatted_categories = {category.id: category.type for category in categories}
-            
-            # Query the questions           
-            questions = Question.query.order_by(Question.id).all()
-            # Paginate the question to display max QUESTIONS_PER_PAGE
-            page, total_pages, current_questions = paginated(request, questions)
-            total_questions = len(questions)
-            #print("questions = {}".format(questions))
-            #print("current_questions = {}".format(current_questions))
-            #print("total_questions = {}".format(total_questions))
-            if not questions:
-                print("There is no question.")
+            formatted_categories, _ = category_cache.get()
+            if stream_format:
+                return stream_questions(question_rows(Question.query), stream_format,
+                                        {"categories": formatted_categories})
+
+            # Query the questions, paginated in SQL to display max QUESTIONS_PER_PAGE
+            page, total_pages, current_questions, total_questions, next_after_id = \
+                paginated(request, Question.query, question_totals.get)
+            if not total_questions:
                 abort(404)
 
             return jsonify({
@@ -100,11 +203,12 @@ def create_app(test_config=None):
                 "questions": current_questions,
                 "categories": formatted_categories,
                 "page": page,
-                "total_pages": total_pages
+                "total_pages": total_pages,
+                "next_after_id": next_after_id
             })
 
         except Exception as e:
-            print(e)
+            app.logger.warning("%s failed: %s", request.endpoint, e)
             abort(422)
 
     """
@@ -118,32 +222,31 @@ def create_app(test_config=None):
     @app.route("/questions/<int:question_id>", methods=["DELETE"])
     def delete_question(question_id):
         try:
-            """ Query the categories """
-            categories = Category.query.order_by(Category.id).all()
-            formatted_categories = {category.id: category.type for category in categories}
-            
             """ Delete the designated question """
-            question = Question.query.filter(Question.id == question_id).one_or_none()
-            print("delete_question -- question: {}".format(question))
-            # Abort if the designated question doesn't exist
-            if question is None:
-                abort(422)
-            # Delete the question
-            question.delete()
-
-            """ Query for the response """
-            questions = Question.query.order_by(Question.id).all()
-            page, total_pages, current_questions = paginated(request, questions)
-
-            return jsonify(
-                {
-                    "success": True,
-                    "deleted": question_id,
-                    "current_questions": current_questions,
-                    "total_questions": len(Question.query.all()),
-                    "categories": formatted_categories,
-                }
-            )
+            if write_pipeline is not None:
+                # Fails when the question doesn't exist
+                write_pipeline.delete(question_id)
+            else:
+                question = db.session.get(Question, question_id)
+                # Abort if the designated question doesn't exist
+                if question is None:
+                    abort(422)
+                # Delete the question
+                question.delete()
+
+            """ Only the total for the response, unless ?include=page """
+            response = {
+                "success": True,
+                "deleted": question_id,
+                "total_questions": question_totals.get(),
+            }
+            if request.args.get("include") == "page":
+                page, total_pages, current_questions, total_questions, next_after_id = \
+                    paginated(request, Question.query, response["total_questions"])
+                response["current_questions"] = current_questions
+                response["categories"], _ = category_cache.get()
+
+            return jsonify(response)
 
         except:
             abort(422)
@@ -170,6 +273,7 @@ def create_app(test_config=None):
     Try using the word "title" to start.
     """
     @app.route("/questions", methods=["POST"])
+    @admission.expensive()
     def create_search_question():
         body = request.get_json()
         searchTerm = body.get("searchTerm", None)
@@ -178,55 +282,171 @@ def create_app(test_config=None):
         new_difficulty = body.get("difficulty", None)
         new_category = body.get("category", None)
         
+        stream_format = request.args.get("stream")
+        if stream_format is not None and stream_format not in STREAM_FORMATS:
+            abort(400)
         try:
+            if searchTerm and stream_format:
+                # Every match, best first, without the highlights
+                return stream_questions(search_index.stream(searchTerm, STREAM_BATCH_SIZE), stream_format)
             if searchTerm:
-                searched_questions = Question.query.order_by(Question.id).filter(
-                    Question.question.ilike("%{}%".format(searchTerm))).all()
-                print("searched_questions: {}".format(searched_questions))           
-                page, total_pages, current_questions = paginated(request, searched_questions)
-                total_questions = len(searched_questions)
-                print("current_questions: {}".format(current_questions))
-                print("total_questions: {}".format(total_questions))
-
-                if searched_questions is None:
-                    abort(404)
-                if searched_questions == []:
-                    current_questions = []
-                    total_questions = 0
+                # Ranked by relevance, paginated by ?page
+                page = request.args.get("page", 1, type=int)
+                total_pages, current_questions, total_questions, highlights = \
+                    search_index.search(searchTerm, page)
             
                 return jsonify(
                     {
                         "success": True,
                         "questions": current_questions,
                         "total_questions": total_questions,
+                        "highlights": highlights,
+                        "page": page,
+                        "total_pages": total_pages,
                     }
                 )
             else:
-                new_question_obj = Question(question=new_question, 
-                                    answer=new_answer, 
-                                    difficulty=new_difficulty,
-                                    category=new_category)
-                new_question_obj.insert()
-
-                selection = Question.query.order_by(Question.id).all()
-                page, total_pages, current_questions = paginated(request, selection)
-                
-                # if the just created question is not unique
-                created_id = new_question_obj.id
+                if write_pipeline is not None:
+                    created = write_pipeline.insert({"question": new_question, "answer": new_answer,
+                                                     "difficulty": new_difficulty, "category": new_category})
+                else:
+                    new_question_obj = Question(question=new_question, 
+                                        answer=new_answer, 
+                                        difficulty=new_difficulty,
+                                        category=new_category)
+                    new_question_obj.insert()
+                    created = new_question_obj.format()
                 
-                return jsonify(
-                    {
-                        "success": True,
-                        "created": created_id,
-                        "questions": current_questions,
-                        "total_questions": len(Question.query.all()),
-                    }
-                )
+                # Only the created question and the total, unless ?include=page
+                response = {
+                    "success": True,
+                    "created": created["id"],
+                    "question": created,
+                    "total_questions": question_totals.get(),
+                }
+                if request.args.get("include") == "page":
+                    page, total_pages, current_questions, total_questions, next_after_id = \
+                        paginated(request, Question.query, response["total_questions"])
+                    response["questions"] = current_questions
+
+                return jsonify(response)
 
         except Exception as e:
-            print(e)
+            app.logger.warning("%s failed: %s", request.endpoint, e)
             abort(422)
     """
+    Bulk import and export of questions, as NDJSON (one JSON object per
+    line) or CSV with a header row, streamed in and out in batches.
+    """
+    @app.route("/questions/import", methods=["POST"])
+    def bulk_import_questions():
+        file_format = request.args.get("format", None)
+        if file_format is None:
+            file_format = "csv" if request.mimetype == "text/csv" else "ndjson"
+        if file_format not in ("ndjson", "csv"):
+            abort(400)
+        batch_size = request.args.get("batch_size", BATCH_SIZE, type=int)
+
+        lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+        records = read_csv(lines) if file_format == "csv" else read_ndjson(lines)
+        categories, _ = category_cache.get()
+        try:
+            imported, failed, errors = import_questions(records, categories, max(batch_size, 1))
+        except Exception as e:
+            app.logger.warning("%s failed: %s", request.endpoint, e)
+            abort(422)
+
+        return jsonify(
+            {
+                "success": True,
+                "imported": imported,
+                "failed": failed,
+                "errors": errors,
+            }
+        )
+
+    @app.route("/questions/export")
+    def bulk_export_questions():
+        file_format = request.args.get("format", "ndjson")
+        if file_format not in ("ndjson", "csv"):
+            abort(400)
+        mimetype = "text/csv" if file_format == "csv" else "application/x-ndjson"
+        return Response(stream_with_context(export_questions(file_format)), mimetype=mimetype)
+
+    @app.cli.command("import-questions")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--format", "file_format", type=click.Choice(["ndjson", "csv"]),
+                  help="Defaults to csv for a .csv file, ndjson otherwise.")
+    @click.option("--batch-size", default=BATCH_SIZE, show_default=True)
+    def import_questions_command(path, file_format, batch_size):
+        """Import questions from an NDJSON or CSV file."""
+        if file_format is None:
+            file_format = "csv" if path.endswith(".csv") else "ndjson"
+        with open(path, encoding="utf-8", newline="") as lines:
+            records = read_csv(lines) if file_format == "csv" else read_ndjson(lines)
+            categories, _ = category_cache.get()
+            imported, failed, errors = import_questions(records, categories, batch_size)
+        for error in errors:
+            click.echo("line {}: {}".format(error["line"], error["error"]), err=True)
+        click.echo("{} questions imported, {} failed".format(imported, failed))
+
+    @app.cli.command("export-questions")
+    @click.argument("path", type=click.Path(dir_okay=False, writable=True))
+    @click.option("--format", "file_format", type=click.Choice(["ndjson", "csv"]),
+                  help="Defaults to csv for a .csv file, ndjson otherwise.")
+    def export_questions_command(path, file_format):
+        """Export the questions to an NDJSON or CSV file."""
+        if file_format is None:
+            file_format = "csv" if path.endswith(".csv") else "ndjson"
+        with open(path, "w", encoding="utf-8", newline="") as output:
+            for chunk in export_questions(file_format):
+                output.write(chunk)
+
+    @app.cli.command("rebuild-counters")
+    def rebuild_counters_command():
+        """Recount the questions per category into the question counters."""
+        counts = QuestionCount.rebuild()
+        generations.bump("questions")
+        click.echo("{} questions in {} categories".format(
+            counts.pop(0), len(counts)))
+
+    @app.cli.command("migrate")
+    @click.option("--retry-failed", is_flag=True, help="Try again the optional migrations that failed.")
+    def migrate_command(retry_failed):
+        """Apply the pending schema migrations."""
+        applied = migrate(db.engine, log=click.echo, retry_failed=retry_failed)
+        if not applied:
+            click.echo("the schema is up to date")
+
+    @app.cli.command("migrations")
+    def migrations_command():
+        """List the schema migrations and whether they are applied."""
+        pending = {migration.version for migration in pending_migrations(db.engine)}
+        with db.engine.begin() as connection:
+            failed = failed_versions(connection)
+        for migration in MIGRATIONS:
+            state = "applied" if migration.version not in pending else \
+                "failed" if migration.version in failed else "pending"
+            click.echo("{:>4} {:<8} {}".format(migration.version, state, migration.description))
+
+    @app.cli.command("build-snapshot")
+    @click.argument("path", type=click.Path(dir_okay=False, writable=True))
+    @click.option("--search-answers", is_flag=True, help="Index the answers for search too.")
+    def build_snapshot_command(path, search_answers):
+        """Write the question bank to a snapshot file for SNAPSHOT_PATH."""
+        click.echo("{} questions written to {}".format(build_snapshot(path, search_answers), path))
+
+    @app.cli.command("merge-journal")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    def merge_journal_command(path):
+        """Apply the writes journaled in snapshot mode to the database."""
+        with open(path, encoding="utf-8") as lines:
+            inserted, deleted, skipped = merge_journal(lines)
+        for line_number, reason in skipped:
+            click.echo("line {}: {}".format(line_number, reason), err=True)
+        click.echo("{} questions inserted, {} deleted, {} skipped".format(inserted, deleted, len(skipped)))
+
+    """
     @TODO:
     Create a GET endpoint to get questions based on category.
 
@@ -235,33 +455,39 @@ def create_app(test_config=None):
     category to be shown.
     """
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @response_cache.cached("questions", "categories")
+    @admission.expensive("questions", "categories")
     def get_questions_by_category(category_id):
-        # Query the category_id's type
-        current_category = Category.query.filter(Category.id==category_id).one_or_none() #returns obj
+        # Look up the category_id's type in the category cache
+        categories, _ = category_cache.get()
+        current_category = categories.get(category_id)
+        stream_format = request.args.get("stream")
+        if stream_format is not None and stream_format not in STREAM_FORMATS:
+            abort(400)
         try:
-            # Query the questions of the category_id
-            questions = Question.query.filter(Question.category==category_id).all()
-            if questions is None:
+            if current_category is None:
                 abort(404)
+            if stream_format:
+                questions = Question.query.filter(Question.category == category_id)
+                return stream_questions(question_rows(questions), stream_format,
+                                        {"categories": current_category})
 
-            elif questions == []:
-                current_questions = []
-                total_questions = 0
-                print("get_questions -- total_questions : {}".format(total_questions))
-            else:
-                page, total_pages, current_questions = paginated(request, questions)
-                total_questions = len(Question.query.all())
+            # Query the questions of the category_id, paginated in SQL
+            questions = Question.query.filter(Question.category==category_id)
+            page, total_pages, current_questions, total_questions, next_after_id = \
+                paginated(request, questions, question_totals.get(category_id))
         
             return jsonify({
                 "success": True,
                 "total_questions": total_questions,
                 "questions": current_questions,
-                "categories": current_category.type,
+                "categories": current_category,
                 "page": page,
-                "total_pages": total_pages
+                "total_pages": total_pages,
+                "next_after_id": next_after_id
             })
         except Exception as e:
-            print(e)
+            app.logger.warning("%s failed: %s", request.endpoint, e)
             abort(404)
     """
     @TODO:
@@ -275,36 +501,109 @@ def create_app(test_config=None):
     and shown whether they were correct or not.
     """
     @app.route('/quizzes', methods=['POST'])
+    @admission.expensive()
     def play_quizz():
         body = request.get_json()
         cat = body.get("quiz_category", None)
-        #print(cat)
         prev_questions = body.get("previous_questions", None)
+        # Optional: the difficulty mode of the deck, and how many questions to prefetch
+        mode = body.get("mode", "uniform")
+        prefetch = body.get("prefetch", None)
+        if mode not in DECK_MODES:
+            abort(400)
         try:
-            print (cat)
-            if cat == {'type': 'click', 'id': 0}:
-                question = Question.query.filter(Question.id.notin_(prev_questions)).\
-                    order_by(func.random()).first()
-            else:
-                question = Question.query.filter(Question.category==cat['id']).\
-                    filter(Question.id.notin_(prev_questions)).\
-                    order_by(func.random()).first()
-            print(question)
-            if question == None:
+            # id 0 is the "All" category of the quiz view
+            category = int(cat["id"]) if cat else 0
+            difficulty = body.get("difficulty", None)
+            count = min(max(int(prefetch), 1), MAX_PREFETCH) if prefetch is not None else 1
+            questions = decks.questions(category or None, prev_questions or [], count, mode,
+                                        int(difficulty) if difficulty is not None else None,
+                                        body.get("distribution", None))
+            if not questions:
                 abort(404)
-            else:
-                current_question = question.format()
-                print(question.format())
-            return jsonify(
-                    {
-                        "success": True,
-                        "question": current_question,
-                    }
-                )
+            response = {
+                "success": True,
+                "question": questions[0].format(),
+            }
+            if prefetch is not None:
+                response["questions"] = [question.format() for question in questions]
+            return jsonify(response)
+        except Exception as e:
+            app.logger.warning("%s failed: %s", request.endpoint, e)
+            abort(422)
+
+    """
+    Batch: several pages and quiz turns in one round trip, their
+    questions read with one SQL statement
+    """
+    @app.route('/batch', methods=['POST'])
+    @admission.expensive()
+    def run_batch_operations():
+        body = request.get_json()
+        operations = body.get("operations", None) if isinstance(body, dict) else None
+        if not isinstance(operations, list) or not 0 < len(operations) <= MAX_OPERATIONS:
+            abort(400)
+        try:
+            categories, _ = category_cache.get()
+            results = run_batch(operations, categories, question_totals.get, decks)
         except Exception as e:
-            print(e)
+            app.logger.warning("%s failed: %s", request.endpoint, e)
             abort(422)
 
+        return jsonify(
+                {
+                    "success": True,
+                    "results": results,
+                }
+            )
+
+    """
+    Quiz sessions: the server keeps the order of the questions of a game,
+    so the client only sends its session token on each turn.
+    """
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
+        body = request.get_json() or {}
+        cat = body.get("quiz_category", None)
+        try:
+            category = int(cat["id"]) if cat else 0
+            token, total_questions = quiz_sessions.start(category or None)
+        except Exception as e:
+            app.logger.warning("%s failed: %s", request.endpoint, e)
+            abort(422)
+
+        return jsonify(
+                {
+                    "success": True,
+                    "session": token,
+                    "total_questions": total_questions,
+                }
+            )
+
+    @app.route('/quizzes/sessions/<token>/next', methods=['POST'])
+    def next_quiz_question(token):
+        try:
+            question = quiz_sessions.next_question(token)
+        except KeyError:
+            abort(404)
+
+        return jsonify(
+                {
+                    "success": True,
+                    "question": question.format() if question is not None else None,
+                }
+            )
+
+    @app.route('/quizzes/sessions/<token>', methods=['DELETE'])
+    def end_quiz_session(token):
+        quiz_sessions.end(token)
+        return jsonify(
+                {
+                    "success": True,
+                    "ended": token,
+                }
+            )
+
     """
     @TODO:
     Create error handlers for all expected errors
@@ -355,6 +654,30 @@ def create_app(test_config=None):
             422,
         )
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return (
+            jsonify({
+                "success": False, 
+                "error": 429, 
+                "message": "too many requests"
+                }), 
+            429,
+            {"Retry-After": str(error.retry_after)} if error.retry_after else {}
+        )
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return (
+            jsonify({
+                "success": False, 
+                "error": 503, 
+                "message": "service unavailable"
+                }), 
+            503,
+            {"Retry-After": str(error.retry_after)} if error.retry_after else {}
+        )
+
     @app.errorhandler(500)
     def internal_error(error):
         return (
@@ -366,6 +689,16 @@ def create_app(test_config=None):
             500
         )
 
+    startup.mark("routes")
+    app.logger.info("app created in %.1f ms (imports %.1f ms)",
+                    sum(startup.phases.values()) * 1000, startup.imports * 1000)
+    if app.config.get("STARTUP_WARM", lazy):
+        warm_up(app, startup, [
+            ("categories", category_cache.get),
+            ("question counts", question_totals.get),
+            ("quiz pools", sampler.pool),
+        ])
+
     return app
     
 
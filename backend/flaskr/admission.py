@@ -0,0 +1,160 @@
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, current_app, request
+
+from models import primary_reads
+
+"""
+_Flight
+    a request being answered by a leader, the identical requests that
+    come in meanwhile wait for its response
+"""
+class _Flight:
+    __slots__ = ("done", "response")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None    # (body, status, headers) once done, if shareable
+
+"""
+AdmissionControl
+    sheds load before it reaches the database.
+
+    When ADMISSION_RATE is set, every request takes a token from the
+    bucket of its client and endpoint, refilled at ADMISSION_RATE tokens
+    a second up to ADMISSION_BURST; an empty bucket is answered with a
+    429 and a Retry-After.
+    The views wrapped with expensive() run at most ADMISSION_MAX_CONCURRENT
+    at a time per process; a request waiting more than
+    ADMISSION_QUEUE_TIMEOUT seconds for its turn is answered with a 503.
+    Identical GET requests (same path, args and table generations) in
+    flight at the same time run the view once, the others get a copy of
+    its response (single-flight); the view then reads from the primary.
+
+    ADMISSION_RATE            tokens a second per client and endpoint, 0 (the
+                              default) to disable
+    ADMISSION_BURST           bucket size (40)
+    ADMISSION_LIMITS          {endpoint: (rate, burst)} overriding the above
+    ADMISSION_CLIENTS         buckets kept, least recently used evicted (10000)
+    ADMISSION_CLIENT_HEADER   header naming the client, e.g. X-Forwarded-For
+                              behind a proxy (the remote address if unset)
+    ADMISSION_MAX_CONCURRENT  expensive views run at once (DB_POOL_SIZE)
+    ADMISSION_QUEUE_TIMEOUT   seconds to wait for a slot (2)
+"""
+class AdmissionControl:
+    def __init__(self, app, generations):
+        self.generations = generations
+        self.rate = app.config.get("ADMISSION_RATE", 0)
+        self.burst = app.config.get("ADMISSION_BURST", 40)
+        self.limits = app.config.get("ADMISSION_LIMITS", {})
+        self.max_clients = app.config.get("ADMISSION_CLIENTS", 10000)
+        self.client_header = app.config.get("ADMISSION_CLIENT_HEADER")
+        self.max_concurrent = app.config.get("ADMISSION_MAX_CONCURRENT", app.config.get("DB_POOL_SIZE", 5))
+        self.queue_timeout = app.config.get("ADMISSION_QUEUE_TIMEOUT", 2)
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()   # (client, endpoint) -> [tokens, updated]
+        self._flights = {}              # key -> _Flight
+        self.rate_limited = 0
+        self.overloaded = 0
+        self.collapsed = 0
+        app.before_request(self.check_rate)
+
+    def _client(self):
+        if self.client_header and request.headers.get(self.client_header):
+            return request.headers[self.client_header].split(",")[0].strip()
+        return request.remote_addr
+
+    """
+    check_rate()
+        takes a token for the request, or aborts with 429
+    """
+    def check_rate(self):
+        if request.method == "OPTIONS" or request.endpoint is None:
+            return
+        rate, burst = self.limits.get(request.endpoint, (self.rate, self.burst))
+        if not rate:
+            return
+        key = (self._client(), request.endpoint)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [burst, now]
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+            self.rate_limited += 1
+            retry_after = math.ceil((1 - bucket[0]) / rate)
+        abort(429, retry_after=retry_after)
+
+    def _run(self, view, args, kwargs):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.overloaded += 1
+            abort(503, retry_after=1)
+        try:
+            return current_app.make_response(view(*args, **kwargs))
+        finally:
+            self._slots.release()
+
+    """
+    expensive(*tables)
+        decorator of a view querying the database: runs it within the
+        concurrency limit, and once for identical GET requests in flight
+        when it only depends on tables
+    """
+    def expensive(self, *tables):
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method != "GET" or not tables:
+                    return self._run(view, args, kwargs)
+                key = "{} {} {}".format(self.generations.version(*tables), request.path,
+                                        sorted(request.args.items(multi=True)))
+                with self._lock:
+                    flight = self._flights.get(key)
+                    leader = flight is None
+                    if leader:
+                        flight = self._flights[key] = _Flight()
+                if not leader:
+                    flight.done.wait(self.queue_timeout)
+                    if flight.response is None:
+                        # The leader failed, streamed or is too slow, run it here
+                        return self._run(view, args, kwargs)
+                    with self._lock:
+                        self.collapsed += 1
+                    body, status, headers = flight.response
+                    return current_app.response_class(body, status=status, headers=headers)
+                try:
+                    # Shared under the current generations, like a cached response
+                    with primary_reads():
+                        response = self._run(view, args, kwargs)
+                    if not response.is_streamed:
+                        flight.response = (response.get_data(), response.status_code, list(response.headers))
+                    return response
+                finally:
+                    with self._lock:
+                        self._flights.pop(key, None)
+                    flight.done.set()
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate_limited": self.rate_limited,
+                "overloaded": self.overloaded,
+                "collapsed": self.collapsed,
+                "in_flight": len(self._flights),
+                "clients": len(self._buckets),
+                "max_concurrent": self.max_concurrent,
+            }
@@ -0,0 +1,322 @@
+import math
+import random
+import time
+
+from quart import Quart, request, abort, jsonify
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import db_path, Question, Category, QuestionCount, ALL_CATEGORIES
+from .generations import GenerationCounter
+from .pagination import QUESTIONS_PER_PAGE
+from .sampling import IdPool
+from .search import highlights, matching, text_rank
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+"""
+async_database_uri(uri)
+    the URI of the async driver of a database URI, asyncpg for PostgreSQL
+"""
+def async_database_uri(uri):
+    scheme, rest = uri.split("://", 1)
+    return "{}://{}".format(ASYNC_DRIVERS.get(scheme.split("+")[0], scheme), rest)
+
+"""
+create_async_app(test_config)
+    the trivia API as an ASGI app (Quart) on SQLAlchemy's async engine,
+    with the same routes and JSON responses as create_app for the
+    categories, questions, search and quizzes. Serve it with:
+
+        hypercorn "flaskr.asgi:create_async_app()"
+
+    The schema is expected to exist, create_app is still the one that
+    sets it up. Quiz sessions, bulk import/export and the response cache
+    are only served by create_app. The writes bump the table generations
+    shared with the create_app workers of the host, so that their caches
+    follow them, and the categories are read again when theirs moves.
+"""
+def create_async_app(test_config=None):
+    app = Quart(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = db_path
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
+    uri = async_database_uri(app.config["SQLALCHEMY_DATABASE_URI"])
+    engine_options = {} if uri.startswith("sqlite") else {
+        "pool_size": app.config.get("ASYNC_POOL_SIZE", 20),
+        "max_overflow": app.config.get("ASYNC_MAX_OVERFLOW", 20),
+        "pool_pre_ping": True,
+    }
+    engine = create_async_engine(uri, **engine_options)
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    app.config["ASYNC_ENGINE"] = engine
+
+    rng = random.Random(app.config.get("QUIZ_RANDOM_SEED"))
+    pool_ttl = app.config.get("QUIZ_POOL_TTL", 60)
+    pools = {}  # category id, None for all -> (loaded at, IdPool)
+    generations = GenerationCounter(app)
+    categories_cache = [None, {}]   # categories generation, {id: type}
+    search_fields = ("question", "answer") if app.config.get("SEARCH_ANSWERS") else ("question",)
+
+    async def get_categories_map(session):
+        generation = generations.get("categories")
+        if categories_cache[0] != generation:
+            rows = await session.execute(select(Category.id, Category.type).order_by(Category.id))
+            categories_cache[:] = [generation, dict(rows.all())]
+        return categories_cache[1]
+
+    async def count(session, category=None):
+        total = await session.scalar(select(QuestionCount.count).where(
+            QuestionCount.category == (ALL_CATEGORIES if category is None else category)))
+        return total or 0
+
+    async def paginated(session, statement, total):
+        page = max(request.args.get("page", 1, type=int), 1)
+        after_id = request.args.get("after_id", None, type=int)
+        statement = statement.order_by(Question.id)
+        if after_id is not None:
+            statement = statement.where(Question.id > after_id)
+        else:
+            statement = statement.offset((page - 1) * QUESTIONS_PER_PAGE)
+        selection = (await session.execute(statement.limit(QUESTIONS_PER_PAGE + 1))).scalars().all()
+        has_next = len(selection) > QUESTIONS_PER_PAGE
+        selection = selection[:QUESTIONS_PER_PAGE]
+        next_after_id = selection[-1].id if has_next else None
+        return page, math.ceil(total/QUESTIONS_PER_PAGE), [question.format() for question in selection], next_after_id
+
+    async def pool(session, category):
+        loaded_at, ids = pools.get(category, (0, None))
+        if ids is None or time.monotonic() - loaded_at > pool_ttl:
+            statement = select(Question.id).order_by(Question.id)
+            if category is not None:
+                statement = statement.where(Question.category == category)
+            ids = IdPool()
+            for question_id in (await session.execute(statement)).scalars():
+                ids.add(question_id)
+            pools[category] = (time.monotonic(), ids)
+        return ids
+
+    async def search(session, term, page):
+        condition, rank = matching(term, search_fields)
+        start = (page - 1) * QUESTIONS_PER_PAGE
+        if engine.dialect.name == "postgresql":
+            total = await session.scalar(select(func.count()).select_from(Question).where(condition))
+            selection = (await session.execute(select(Question).where(condition).
+                         order_by(rank.desc(), Question.id).offset(start).limit(QUESTIONS_PER_PAGE))).scalars().all()
+            return total, selection
+        # Ranked like the in-process index of create_app
+        term = term.lower()
+        columns = [getattr(Question, field) for field in search_fields]
+        ranked = []
+        for row in await session.execute(select(Question.id, *columns).where(condition)):
+            rank = text_rank(tuple((field_text or "").lower() for field_text in row[1:]), term)
+            if rank is not None:
+                ranked.append(rank + (row[0],))
+        ranked.sort()
+        ids = [question_id for _, _, question_id in ranked[start:start + QUESTIONS_PER_PAGE]]
+        by_id = {question.id: question for question in
+                 (await session.execute(select(Question).where(Question.id.in_(ids)))).scalars()} if ids else {}
+        return len(ranked), [by_id[question_id] for question_id in ids if question_id in by_id]
+
+    def forget(question_id):
+        for _, ids in pools.values():
+            ids.remove(question_id)
+
+    @app.after_request
+    async def after_request(response):
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Headers"] = "Content-Type,Authorization,true"
+        response.headers["Access-Control-Allow-Methods"] = "GET,POST,PUT,PATCH,DELETE,OPTIONS"
+        return response
+
+    @app.route("/categories")
+    async def get_categories():
+        async with Session() as session:
+            categories = await get_categories_map(session)
+            if len(categories) == 0:
+                abort(404)
+            return jsonify({
+                "success": True,
+                "categories": categories,
+                "total_categories": len(categories)
+            })
+
+    @app.route("/questions")
+    async def get_questions():
+        async with Session() as session:
+            try:
+                formatted_categories = await get_categories_map(session)
+                total_questions = await count(session)
+                page, total_pages, current_questions, next_after_id = \
+                    await paginated(session, select(Question), total_questions)
+                if not total_questions:
+                    abort(404)
+
+                return jsonify({
+                    "success": True,
+                    "total_questions": total_questions,
+                    "questions": current_questions,
+                    "categories": formatted_categories,
+                    "page": page,
+                    "total_pages": total_pages,
+                    "next_after_id": next_after_id
+                })
+            except Exception as e:
+                app.logger.warning("%s failed: %s", request.endpoint, e)
+                abort(422)
+
+    @app.route("/questions/<int:question_id>", methods=["DELETE"])
+    async def delete_question(question_id):
+        async with Session() as session:
+            try:
+                question = await session.get(Question, question_id)
+                if question is None:
+                    abort(422)
+                await session.delete(question)
+                for upsert in QuestionCount.upserts({question.category: -1}, engine.dialect.name):
+                    await session.execute(upsert)
+                await session.commit()
+                generations.bump("questions")
+                forget(question_id)
+
+                response = {
+                    "success": True,
+                    "deleted": question_id,
+                    "total_questions": await count(session),
+                }
+                if request.args.get("include") == "page":
+                    page, total_pages, current_questions, next_after_id = \
+                        await paginated(session, select(Question), response["total_questions"])
+                    response["current_questions"] = current_questions
+                    response["categories"] = await get_categories_map(session)
+                return jsonify(response)
+            except Exception:
+                abort(422)
+
+    @app.route("/questions", methods=["POST"])
+    async def create_search_question():
+        body = await request.get_json()
+        searchTerm = body.get("searchTerm", None)
+        async with Session() as session:
+            try:
+                if searchTerm:
+                    page = max(request.args.get("page", 1, type=int), 1)
+                    total_questions, selection = await search(session, searchTerm, page)
+                    current_questions = [question.format() for question in selection]
+
+                    return jsonify(
+                        {
+                            "success": True,
+                            "questions": current_questions,
+                            "total_questions": total_questions,
+                            "highlights": highlights(current_questions, searchTerm, search_fields),
+                            "page": page,
+                            "total_pages": math.ceil(total_questions/QUESTIONS_PER_PAGE),
+                        }
+                    )
+                else:
+                    new_question_obj = Question(question=body.get("question", None),
+                                        answer=body.get("answer", None),
+                                        difficulty=body.get("difficulty", None),
+                                        category=body.get("category", None))
+                    session.add(new_question_obj)
+                    await session.flush()
+                    for upsert in QuestionCount.upserts({new_question_obj.category: 1}, engine.dialect.name):
+                        await session.execute(upsert)
+                    await session.commit()
+                    generations.bump("questions")
+                    for category in (None, new_question_obj.category):
+                        if category in pools:
+                            pools[category][1].add(new_question_obj.id)
+
+                    response = {
+                        "success": True,
+                        "created": new_question_obj.id,
+                        "question": new_question_obj.format(),
+                        "total_questions": await count(session),
+                    }
+                    if request.args.get("include") == "page":
+                        page, total_pages, current_questions, next_after_id = \
+                            await paginated(session, select(Question), response["total_questions"])
+                        response["questions"] = current_questions
+                    return jsonify(response)
+            except Exception as e:
+                app.logger.warning("%s failed: %s", request.endpoint, e)
+                abort(422)
+
+    @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    async def get_questions_by_category(category_id):
+        async with Session() as session:
+            categories = await get_categories_map(session)
+            current_category = categories.get(category_id)
+            if current_category is None:
+                abort(404)
+            total_questions = await count(session, category_id)
+            page, total_pages, current_questions, next_after_id = await paginated(
+                session, select(Question).where(Question.category == category_id), total_questions)
+
+            return jsonify({
+                "success": True,
+                "total_questions": total_questions,
+                "questions": current_questions,
+                "categories": current_category,
+                "page": page,
+                "total_pages": total_pages,
+                "next_after_id": next_after_id
+            })
+
+    @app.route('/quizzes', methods=['POST'])
+    async def play_quizz():
+        body = await request.get_json()
+        cat = body.get("quiz_category", None)
+        seen = set(body.get("previous_questions", None) or [])
+        async with Session() as session:
+            try:
+                category = int(cat["id"]) if cat else 0
+                ids = await pool(session, category or None)
+                question = None
+                while question is None:
+                    question_id = ids.draw(rng, seen)
+                    if question_id is None:
+                        break
+                    question = await session.get(Question, question_id)
+                    seen.add(question_id)
+                if question is None:
+                    abort(404)
+
+                return jsonify(
+                        {
+                            "success": True,
+                            "question": question.format(),
+                        }
+                    )
+            except Exception as e:
+                app.logger.warning("%s failed: %s", request.endpoint, e)
+                abort(422)
+
+    @app.errorhandler(400)
+    async def bad_request(error):
+        return jsonify({"success": False, "error": 400, "message": "bad request"}), 400
+
+    @app.errorhandler(404)
+    async def not_found(error):
+        return jsonify({"success": False, "error": 404, "message": "resource not found"}), 404
+
+    @app.errorhandler(405)
+    async def not_allowed(error):
+        return jsonify({"success": False, "error": 405, "message": "method not allowed"}), 405
+
+    @app.errorhandler(422)
+    async def unprocessable(error):
+        return jsonify({"success": False, "error": 422, "message": "unprocessable"}), 422
+
+    @app.errorhandler(500)
+    async def internal_error(error):
+        return jsonify({"success": False, "error": 500, "message": "internal error"}), 500
+
+    return app
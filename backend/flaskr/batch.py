@@ -0,0 +1,126 @@
+import math
+from sqlalchemy import literal, select, union_all
+
+from models import db, Question
+from .decks import MAX_PREFETCH, MODES as DECK_MODES
+from .pagination import QUESTIONS_PER_PAGE
+from .serialization import QUESTION_COLUMNS, QuestionRows
+
+MAX_OPERATIONS = 20
+OPERATIONS = ("questions", "quiz")
+ERRORS = {400: "bad request", 404: "resource not found", 422: "unprocessable"}
+
+class BatchError(Exception):
+    def __init__(self, status):
+        super().__init__(ERRORS[status])
+        self.status = status
+
+def _page(operation):
+    page = int(operation.get("page", 1))
+    after_id = operation.get("after_id", None)
+    return max(page, 1), int(after_id) if after_id is not None else None
+
+def _window(index, category, page, after_id):
+    query = select(*QUESTION_COLUMNS, literal(index).label("operation"))
+    if category is not None:
+        query = query.where(Question.category == category)
+    if after_id is not None:
+        query = query.where(Question.id > after_id)
+    else:
+        query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+    # One row past the page tells whether a next page exists
+    return select(query.order_by(Question.id).limit(QUESTIONS_PER_PAGE + 1).subquery())
+
+"""
+run_batch(operations, categories, totals, decks)
+    runs a list of operations and returns their results in order, reading
+    the questions of all of them with one SQL statement: the page windows
+    and the ids drawn for the quizzes as one UNION ALL.
+
+    {"op": "questions", "category": id, "page": N, "after_id": N}
+        a page of the questions, of a category when given, like
+        GET /questions and GET /categories/<id>/questions
+    {"op": "quiz", "quiz_category": {...}, "previous_questions": [...],
+     "count": N, "mode": ..., "difficulty": ..., "distribution": {...}}
+        the next count questions of a quiz, like POST /quizzes
+
+    A failed operation has {"success": false, "error", "message"} as
+    its result, the others are still run.
+"""
+def run_batch(operations, categories, totals, decks):
+    results = [None] * len(operations)
+    windows = []        # (index, category, page, after_id)
+    draws = {}          # index -> planned ids
+    for index, operation in enumerate(operations):
+        try:
+            if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+                raise BatchError(400)
+            if operation["op"] == "questions":
+                category = operation.get("category", None)
+                if category is not None:
+                    category = int(category)
+                    if category not in categories:
+                        raise BatchError(404)
+                windows.append((index, category) + _page(operation))
+            else:
+                mode = operation.get("mode", "uniform")
+                if mode not in DECK_MODES:
+                    raise BatchError(400)
+                cat = operation.get("quiz_category", None)
+                # id 0 is the "All" category of the quiz view
+                category = int(cat["id"]) if cat else 0
+                difficulty = operation.get("difficulty", None)
+                count = min(max(int(operation.get("count", 1)), 1), MAX_PREFETCH)
+                ids = decks.plan(category or None, operation.get("previous_questions", None) or [], count, mode,
+                                 int(difficulty) if difficulty is not None else None,
+                                 operation.get("distribution", None))
+                if not ids:
+                    raise BatchError(404)
+                draws[index] = ids
+        except BatchError as e:
+            results[index] = {"success": False, "error": e.status, "message": str(e)}
+        except (TypeError, ValueError, KeyError, AttributeError):
+            results[index] = {"success": False, "error": 422, "message": ERRORS[422]}
+
+    selects = [_window(*window) for window in windows]
+    drawn = {question_id for ids in draws.values() for question_id in ids}
+    if drawn:
+        selects.append(select(*QUESTION_COLUMNS, literal(-1).label("operation")).
+                       where(Question.id.in_(drawn)))
+    rows = {}           # operation index -> rows, -1 for the drawn questions
+    if selects:
+        statement = selects[0] if len(selects) == 1 else union_all(*selects)
+        for row in db.session.execute(statement):
+            rows.setdefault(row.operation, []).append(row)
+
+    for index, category, page, after_id in windows:
+        selection = rows.get(index, [])
+        has_next = len(selection) > QUESTIONS_PER_PAGE
+        selection = sorted(selection, key=lambda row: row.id)[:QUESTIONS_PER_PAGE]
+        total_questions = totals(category)
+        results[index] = {
+            "success": True,
+            "total_questions": total_questions,
+            "questions": QuestionRows(selection),
+            "categories": categories if category is None else categories[category],
+            "page": page,
+            "total_pages": math.ceil(total_questions/QUESTIONS_PER_PAGE),
+            "next_after_id": selection[-1].id if has_next else None,
+        }
+
+    by_id = {row.id: row for row in rows.get(-1, [])}
+    for index, ids in draws.items():
+        for question_id in ids:
+            if question_id not in by_id:
+                # Deleted by another process since the pools were loaded
+                decks.sampler.discard(question_id)
+        questions = QuestionRows(by_id[question_id] for question_id in ids if question_id in by_id)
+        if not questions:
+            results[index] = {"success": False, "error": 404, "message": ERRORS[404]}
+            continue
+        results[index] = {
+            "success": True,
+            "question": questions.format()[0],
+            "questions": questions,
+        }
+    return results
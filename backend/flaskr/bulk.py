@@ -0,0 +1,153 @@
+import csv
+import io
+import json
+
+from models import db, notify_write, Question, QuestionCount
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+FIELDS = ("question", "answer", "category", "difficulty")
+EXPORT_FIELDS = ("id",) + FIELDS
+
+"""
+read_ndjson(lines) / read_csv(lines)
+    yield (line_number, record) for each record of a text stream,
+    record being a dict, or an error message for a malformed line
+"""
+def read_ndjson(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, "invalid JSON: {}".format(e)
+            continue
+        yield line_number, record if isinstance(record, dict) else "expected a JSON object"
+
+def read_csv(lines):
+    reader = csv.DictReader(lines)
+    for record in reader:
+        yield reader.line_num, record
+
+"""
+validate(record, categories)
+    the row to insert for a record, or raises ValueError
+"""
+def validate(record, categories=None):
+    row = {}
+    for field in ("question", "answer"):
+        value = record.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError("{} is required".format(field))
+        row[field] = value
+    for field in ("category", "difficulty"):
+        try:
+            row[field] = int(record.get(field))
+        except (TypeError, ValueError):
+            raise ValueError("{} must be an integer".format(field))
+    if categories is not None and row["category"] not in categories:
+        raise ValueError("category {} does not exist".format(row["category"]))
+    return row
+
+def _copy_batch(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[field] for field in FIELDS])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        "COPY questions ({}) FROM STDIN WITH (FORMAT csv)".format(", ".join(FIELDS)), buffer)
+
+def _insert_batch(rows, use_copy):
+    if use_copy:
+        _copy_batch(rows)
+    else:
+        # One executemany for the whole batch
+        db.session.execute(Question.__table__.insert(), rows)
+    deltas = {}
+    for row in rows:
+        deltas[row["category"]] = deltas.get(row["category"], 0) + 1
+    QuestionCount.adjust(deltas)
+    db.session.commit()
+
+"""
+import_questions(records, categories, batch_size, use_copy)
+    validates and inserts (line_number, record) pairs in batches, one
+    transaction per batch, with PostgreSQL COPY when use_copy is set.
+    A batch the database rejects is retried row by row to report the
+    failing rows. Returns the number of imported and failed rows, and the
+    first MAX_REPORTED_ERRORS errors.
+"""
+def import_questions(records, categories=None, batch_size=BATCH_SIZE, use_copy=None):
+    if use_copy is None:
+        use_copy = db.engine.dialect.name == "postgresql"
+    imported = 0
+    failed = 0
+    errors = []
+    batch = []
+
+    def report(line_number, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"line": line_number, "error": error})
+
+    def flush():
+        nonlocal imported
+        if not batch:
+            return
+        rows = [row for _, row in batch]
+        try:
+            _insert_batch(rows, use_copy)
+            imported += len(rows)
+        except Exception:
+            db.session.rollback()
+            for line_number, row in batch:
+                try:
+                    _insert_batch([row], False)
+                    imported += 1
+                except Exception as e:
+                    db.session.rollback()
+                    report(line_number, str(getattr(e, "orig", e)).strip())
+        batch.clear()
+
+    for line_number, record in records:
+        try:
+            if isinstance(record, str):
+                raise ValueError(record)
+            batch.append((line_number, validate(record, categories)))
+        except ValueError as e:
+            report(line_number, str(e))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    if imported:
+        notify_write("questions", "bulk", [])
+    return imported, failed, errors
+
+"""
+export_questions(format)
+    yields the questions as NDJSON lines or CSV rows, in id order, read
+    from a server-side cursor yield_per rows at a time
+"""
+def export_questions(format="ndjson", yield_per=BATCH_SIZE):
+    columns = [getattr(Question, field) for field in EXPORT_FIELDS]
+    rows = db.session.query(*columns).order_by(Question.id).\
+        execution_options(stream_results=True).yield_per(yield_per)
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n"
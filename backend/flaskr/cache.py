@@ -0,0 +1,176 @@
+import functools
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, request
+
+from models import add_write_hook, primary_reads
+
+"""
+MemoryCacheBackend
+    an LRU of at most max_entries responses of this process
+"""
+class MemoryCacheBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (body, mimetype, tables, expires)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[:2]
+
+    def set(self, key, body, mimetype, tables, expires):
+        with self._lock:
+            self._entries[key] = (body, mimetype, tables, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def purge(self, table):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if table in entry[2]]:
+                del self._entries[key]
+
+"""
+SqliteCacheBackend
+    responses stored in a local SQLite file shared by every worker
+    process of the host, evicting the least recently used past max_entries
+"""
+class SqliteCacheBackend:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, "
+                "mimetype TEXT, tables TEXT, expires REAL, used REAL)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=1)
+            connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def __len__(self):
+        return self._connection().execute("SELECT count(*) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT body, mimetype FROM responses WHERE key = ? AND expires >= ?",
+                (key, time.time())).fetchone()
+            if row is not None:
+                connection.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def set(self, key, body, mimetype, tables, expires):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, body, mimetype, " ".join(tables), expires, time.time()))
+            connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def purge(self, table):
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM responses WHERE ' ' || tables || ' ' LIKE ?", ("% {} %".format(table),))
+
+"""
+ResponseCache
+    caches the JSON of GET endpoints keyed on the route, the query args
+    and the generation of the tables the response is built from.
+
+    A write to one of those tables moves its generation, so a stale entry
+    can no longer be reached from any worker, and the entries of this
+    process depending on the table are purged right away.
+    Responses carry an ETag and a Last-Modified derived from the table
+    generations, and a matching If-None-Match is answered with a 304
+    before the cache or the database is looked at. The views cached run
+    within primary_reads().
+
+    RESPONSE_CACHE_SIZE  max entries (1024)
+    RESPONSE_CACHE_TTL   seconds an entry is served (60)
+    RESPONSE_CACHE_PATH  SQLite file shared by the workers, in memory if unset
+"""
+class ResponseCache:
+    def __init__(self, app, generations):
+        self.generations = generations
+        self.ttl = app.config.get("RESPONSE_CACHE_TTL", 60)
+        max_entries = app.config.get("RESPONSE_CACHE_SIZE", 1024)
+        path = app.config.get("RESPONSE_CACHE_PATH")
+        if path:
+            self.backend = SqliteCacheBackend(path, max_entries)
+        else:
+            self.backend = MemoryCacheBackend(max_entries)
+        self.max_entries = max_entries
+        self.hits = {}
+        self.misses = {}
+        add_write_hook(app, self.on_write)
+
+    """
+    cached(*tables)
+        decorator of a GET view whose response only depends on tables
+    """
+    def cached(self, *tables):
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                version = self.generations.version(*tables)
+                key = "{} {} {}".format(version, request.path, sorted(request.args.items(multi=True)))
+                etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+                last_modified = max(self.generations.modified_at(table) for table in tables)
+
+                if request.if_none_match.contains(etag):
+                    response = current_app.response_class(status=304)
+                else:
+                    entry = self.backend.get(key)
+                    if entry is not None:
+                        self.hits[view.__name__] = self.hits.get(view.__name__, 0) + 1
+                        response = current_app.response_class(entry[0], mimetype=entry[1])
+                    else:
+                        self.misses[view.__name__] = self.misses.get(view.__name__, 0) + 1
+                        # Stored under the current generations, a lagging replica
+                        # would be served as current until the next write
+                        with primary_reads():
+                            response = view(*args, **kwargs)
+                        # Streamed bodies are not buffered to be cached
+                        if response.status_code == 200 and not response.is_streamed:
+                            self.backend.set(key, response.get_data(), response.mimetype,
+                                             tables, time.time() + self.ttl)
+                response.set_etag(etag)
+                response.last_modified = last_modified
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "endpoints": {
+                endpoint: {"hits": self.hits.get(endpoint, 0), "misses": self.misses.get(endpoint, 0)}
+                for endpoint in set(self.hits) | set(self.misses)
+            },
+            "entries": len(self.backend),
+            "max_entries": self.max_entries,
+        }
+
+    def on_write(self, table, action, rows):
+        self.backend.purge(table)
@@ -0,0 +1,44 @@
+import hashlib
+import json
+import threading
+
+from models import primary_reads, Category
+
+"""
+CategoryCache
+    the {id: type} map of the categories, loaded once per process and
+    reloaded only when the "categories" generation has moved, which
+    Category writes of any worker do through the write hooks.
+    The ETag of the map is a hash of its content.
+    With a SharedMetadata, the map is read from it instead of the table.
+"""
+class CategoryCache:
+    def __init__(self, generations, metadata=None):
+        self.generations = generations
+        self.metadata = metadata
+        self._lock = threading.Lock()
+        self._generation = None
+        self._entry = None      # (categories, etag)
+
+    """
+    get()
+        the categories map and its ETag, queried only when stale
+    """
+    def get(self):
+        generation = self.generations.get("categories")
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self._load(generation)
+        return self._entry
+
+    def _load(self, generation):
+        if self.metadata is not None:
+            categories = dict(sorted(self.metadata.categories().items()))
+        else:
+            with primary_reads():
+                selection = Category.query.order_by(Category.id).all()
+            categories = {category.id: category.type for category in selection}
+        digest = hashlib.sha1(json.dumps(sorted(categories.items())).encode()).hexdigest()
+        self._entry = (categories, "categories-{}".format(digest[:16]))
+        self._generation = generation
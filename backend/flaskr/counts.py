@@ -0,0 +1,52 @@
+import threading
+
+from models import add_write_hook, primary_reads, ALL_CATEGORIES, QuestionCount
+
+"""
+QuestionTotals
+    the question counters of the question_counts table, read once and
+    then maintained from the write hooks of this process.
+    They are tied to the "questions" generation: a write of this process
+    moves the generation by one and the counters by the inserted or deleted
+    rows, while a generation moved by another process makes them reload
+    the counters table.
+    Must be registered after the GenerationCounter hook.
+"""
+class QuestionTotals:
+    def __init__(self, app, generations):
+        self.generations = generations
+        self._lock = threading.Lock()
+        self._entry = None      # (generation, {category: count})
+        add_write_hook(app, self.on_write)
+
+    def counts(self):
+        generation = self.generations.get("questions")
+        entry = self._entry
+        if entry is None or entry[0] != generation:
+            with self._lock, primary_reads():
+                counts = QuestionCount.counts()
+                entry = self._entry = (generation, counts)
+        return entry[1]
+
+    """
+    get(category)
+        the number of questions of category, of all the questions if None
+    """
+    def get(self, category=None):
+        return self.counts().get(ALL_CATEGORIES if category is None else category, 0)
+
+    def on_write(self, table, action, rows):
+        if table != "questions":
+            return
+        generation = self.generations.get("questions")
+        with self._lock:
+            entry = self._entry
+            if entry is None or entry[0] != generation - 1 or action not in ("insert", "delete"):
+                self._entry = None
+                return
+            counts = dict(entry[1])
+            for row in rows:
+                delta = 1 if action == "insert" else -1
+                counts[row["category"]] = counts.get(row["category"], 0) + delta
+                counts[ALL_CATEGORIES] = counts.get(ALL_CATEGORIES, 0) + delta
+            self._entry = (generation, counts)
@@ -0,0 +1,94 @@
+from models import Question
+
+MODES = ("uniform", "escalating", "target", "distribution")
+MAX_PREFETCH = 50
+
+"""
+QuizDecks
+    plans the next questions of a quiz from the difficulty pools of the
+    sampler, in memory, and loads them with one primary key query.
+
+    uniform       any difficulty (the default)
+    escalating    the easiest difficulty on the first turns, one step
+                  harder every QUIZ_TURNS_PER_LEVEL turns (1 by default)
+    target        the given difficulty
+    distribution  a difficulty drawn with the given {difficulty: weight}
+
+    When the planned difficulty has no unseen question left, the nearest
+    difficulty that has one is used, the harder one first.
+"""
+class QuizDecks:
+    def __init__(self, app, sampler):
+        self.sampler = sampler
+        self.turns_per_level = max(app.config.get("QUIZ_TURNS_PER_LEVEL", 1), 1)
+
+    def _difficulty(self, mode, turn, levels, difficulty, distribution):
+        if mode == "escalating":
+            return levels[min(turn // self.turns_per_level, len(levels) - 1)]
+        if mode == "target":
+            return difficulty
+        if mode == "distribution":
+            weighted = [(level, distribution.get(level, 0)) for level in levels]
+            weighted = [(level, weight) for level, weight in weighted if weight > 0]
+            if weighted:
+                pick = self.sampler.random.uniform(0, sum(weight for _, weight in weighted))
+                for level, weight in weighted:
+                    pick -= weight
+                    if pick <= 0:
+                        return level
+                return weighted[-1][0]
+        return None
+
+    def _draw(self, category, seen, difficulty, levels):
+        if difficulty is None:
+            return self.sampler.draw(category, seen)
+        # The planned difficulty first, then the nearest ones, harder first
+        for level in sorted(levels, key=lambda level: (abs(level - difficulty), -level)):
+            question_id = self.sampler.draw(category, seen, level)
+            if question_id is not None:
+                return question_id
+        return None
+
+    """
+    plan(category, previous_questions, count, mode, difficulty, distribution)
+        the ids of the next count questions of the quiz, fewer when the
+        category runs out of questions
+    """
+    def plan(self, category=None, previous_questions=(), count=1, mode="uniform",
+             difficulty=None, distribution=None):
+        seen = set(previous_questions)
+        levels = self.sampler.difficulties(category) if mode != "uniform" else []
+        distribution = {int(level): float(weight) for level, weight in (distribution or {}).items()}
+        ids = []
+        for turn in range(len(seen), len(seen) + count):
+            planned = self._difficulty(mode, turn, levels, difficulty, distribution) if levels else None
+            question_id = self._draw(category, seen, planned, levels)
+            if question_id is None:
+                break
+            ids.append(question_id)
+            seen.add(question_id)
+        return ids
+
+    """
+    questions(...)
+        the Question objects of plan(), in order, loaded with one
+        WHERE id IN (...) query. Questions deleted by another process
+        since the pools were loaded are dropped from the pools and replaced.
+    """
+    def questions(self, category=None, previous_questions=(), count=1, mode="uniform",
+                  difficulty=None, distribution=None):
+        seen = set(previous_questions)
+        questions = []
+        while len(questions) < count:
+            ids = self.plan(category, seen, count - len(questions), mode, difficulty, distribution)
+            if not ids:
+                break
+            by_id = {question.id: question for question in Question.query.filter(Question.id.in_(ids))}
+            for question_id in ids:
+                question = by_id.get(question_id)
+                if question is None:
+                    self.sampler.discard(question_id)
+                else:
+                    questions.append(question)
+            seen.update(ids)
+        return questions
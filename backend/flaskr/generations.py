@@ -0,0 +1,85 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SLOTS = ("categories", "questions")
+SLOT = struct.Struct("<Qd")  # generation, time of the last bump
+
+"""
+GenerationCounter
+    per-table generation counters in a small memory-mapped file, shared by
+    every worker process of the host. A write bumps the counter of its
+    table; a process holding a copy of the table compares the generation
+    it was built from to know whether the copy is stale.
+    Reading a counter is a read from shared memory, with no system call.
+
+    GENERATIONS_PATH  the file, by default one per database in the temp dir
+"""
+class GenerationCounter:
+    def __init__(self, app):
+        uri = app.config.get("SQLALCHEMY_DATABASE_URI", "")
+        self.path = app.config.get("GENERATIONS_PATH") or os.path.join(
+            tempfile.gettempdir(), "trivia-generations-{}".format(hashlib.sha1(uri.encode()).hexdigest()[:12]))
+        self._lock = threading.Lock()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = SLOT.size * len(SLOTS)
+            created = os.fstat(fd).st_size < size
+            if created:
+                os.ftruncate(fd, size)
+            self._fd = fd
+            self._map = mmap.mmap(fd, size)
+            if created:
+                # A new file cannot tell when the tables last changed
+                for table in SLOTS:
+                    SLOT.pack_into(self._map, self._offset(table), 0, time.time())
+        except Exception:
+            os.close(fd)
+            raise
+
+    def _offset(self, table):
+        return SLOTS.index(table) * SLOT.size
+
+    def get(self, table):
+        return SLOT.unpack_from(self._map, self._offset(table))[0]
+
+    """
+    modified_at(table)
+        the time of the last bump, or of the creation of the file, as a
+        Unix timestamp
+    """
+    def modified_at(self, table):
+        return SLOT.unpack_from(self._map, self._offset(table))[1]
+
+    def bump(self, table):
+        offset = self._offset(table)
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                generation = SLOT.unpack_from(self._map, offset)[0] + 1
+                SLOT.pack_into(self._map, offset, generation, time.time())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return generation
+
+    """
+    version(*tables)
+        a string identifying the current state of tables, which changes
+        with every bump, also across a recreated file
+    """
+    def version(self, *tables):
+        return "-".join("{}.{}".format(self.get(table), int(self.modified_at(table) * 1000)) for table in tables)
+
+    def on_write(self, table, action, rows):
+        self.bump(table)
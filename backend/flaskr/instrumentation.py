@@ -0,0 +1,270 @@
+import cProfile
+import functools
+import os
+import random
+import tempfile
+import threading
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+from models import Question, Category
+from .serialization import QuestionJSONProvider
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PHASES = ("db", "view", "format", "json")
+
+"""
+RequestTimings
+    what one request spent, filled by the engine, mapper, format() and
+    JSON hooks below while g.trivia_timings is set
+"""
+class RequestTimings:
+    __slots__ = ("started", "db", "format", "json", "queries", "rows", "full_scans", "_statement_started")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db = self.format = self.json = 0.0
+        self.queries = self.rows = 0
+        self.full_scans = []
+        self._statement_started = None
+
+def _current():
+    return g.get("trivia_timings") if has_app_context() else None
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    timings = _current()
+    if timings is not None:
+        timings._statement_started = time.perf_counter()
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    timings = _current()
+    if timings is None or timings._statement_started is None:
+        return
+    timings.db += time.perf_counter() - timings._statement_started
+    timings._statement_started = None
+    timings.queries += 1
+    # A read of the questions with neither a filter nor a limit is a full table load
+    upper = statement.upper()
+    if upper.startswith("SELECT") and "FROM QUESTIONS" in upper and "WHERE" not in upper and "LIMIT" not in upper:
+        timings.full_scans.append(" ".join(statement.split())[:200])
+
+def _on_load(target, context):
+    timings = _current()
+    if timings is not None:
+        timings.rows += 1
+
+def _timed_format(format):
+    @functools.wraps(format)
+    def wrapper(self):
+        timings = _current()
+        if timings is None:
+            return format(self)
+        started = time.perf_counter()
+        try:
+            return format(self)
+        finally:
+            timings.format += time.perf_counter() - started
+    wrapper.trivia_timed = True
+    return wrapper
+
+_installed = threading.Lock()
+
+def _install_hooks():
+    # Class-level hooks, shared by every app of the process and free when
+    # no request is being timed
+    with _installed:
+        if getattr(Question.format, "trivia_timed", False):
+            return
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Mapper, "load", _on_load)
+        for model in (Question, Category):
+            model.format = _timed_format(model.format)
+
+"""
+TimedJSONProvider
+    the JSON provider of the app, adding the time spent encoding to the
+    request
+"""
+class TimedJSONProvider(QuestionJSONProvider):
+    def dumps(self, obj, **kwargs):
+        timings = _current()
+        if timings is None:
+            return super().dumps(obj, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            timings.json += time.perf_counter() - started
+
+"""
+Instrumentation
+    per-request timings split into database time, the rest of the view
+    (ORM hydration included), format() serialization and JSON encoding, returned
+    in a Server-Timing header and aggregated per endpoint for /metrics in
+    the Prometheus text format.
+
+    The queries of each request are counted. A request running more than
+    INSTRUMENTATION_MAX_QUERIES queries (N+1), loading more than
+    INSTRUMENTATION_MAX_ROWS ORM objects, or reading the questions table
+    without a WHERE or a LIMIT is logged and counted as flagged.
+
+    PROFILE_SAMPLE_RATE (0 by default) profiles that fraction of the
+    requests with cProfile and writes the stats to PROFILE_DIR, one file
+    per profiled request, to be read with pstats or snakeviz.
+
+    INSTRUMENTATION = False turns all of it off.
+"""
+class Instrumentation:
+    def __init__(self, app):
+        self.app = app
+        self.max_queries = app.config.get("INSTRUMENTATION_MAX_QUERIES", 20)
+        self.max_rows = app.config.get("INSTRUMENTATION_MAX_ROWS", 1000)
+        self.slow_seconds = app.config.get("INSTRUMENTATION_SLOW_MS", 500) / 1000
+        self.profile_rate = app.config.get("PROFILE_SAMPLE_RATE", 0)
+        self.profile_dir = app.config.get("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "trivia-profiles")
+        self._lock = threading.Lock()
+        self._endpoints = {}    # endpoint -> dict of counters
+        self._statuses = {}     # (endpoint, status) -> count
+        self._flags = {}        # kind -> count
+        self.profiled = 0
+        if not app.config.get("INSTRUMENTATION", True):
+            return
+
+        _install_hooks()
+        app.json = TimedJSONProvider(app)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.trivia_timings = RequestTimings()
+        if self.profile_rate and random.random() < self.profile_rate:
+            g.trivia_profile = cProfile.Profile()
+            g.trivia_profile.enable()
+
+    def after_request(self, response):
+        timings = g.pop("trivia_timings", None)
+        if timings is None:
+            return response
+        profile = g.pop("trivia_profile", None)
+        if profile is not None:
+            profile.disable()
+            self._dump_profile(profile)
+
+        total = time.perf_counter() - timings.started
+        phases = {
+            "db": timings.db,
+            # Not measured: what is left of the request, ORM hydration included
+            "view": max(total - timings.db - timings.format - timings.json, 0.0),
+            "format": timings.format,
+            "json": timings.json,
+        }
+        response.headers["Server-Timing"] = ", ".join(
+            "{};dur={:.3f}".format(name, seconds * 1000) for name, seconds in
+            list(phases.items()) + [("total", total)])
+        response.headers["X-Query-Count"] = str(timings.queries)
+
+        endpoint = request.endpoint or "unmatched"
+        flags = []
+        if timings.queries > self.max_queries:
+            flags.append("queries")
+        if timings.rows > self.max_rows:
+            flags.append("rows")
+        if timings.full_scans:
+            flags.append("full_scan")
+        if flags or total > self.slow_seconds:
+            self.app.logger.warning(
+                "%s %s: %.1f ms (db %.1f, format %.1f, json %.1f), %d queries, %d rows%s%s",
+                request.method, request.path, total * 1000, timings.db * 1000, timings.format * 1000,
+                timings.json * 1000, timings.queries, timings.rows,
+                ", flagged " + ", ".join(flags) if flags else "",
+                "".join("\n    full table load: " + statement for statement in timings.full_scans))
+        self._record(endpoint, response.status_code, total, phases, timings, flags)
+        return response
+
+    def _record(self, endpoint, status, total, phases, timings, flags):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    "count": 0, "seconds": 0.0, "queries": 0, "rows": 0,
+                    "buckets": [0] * len(BUCKETS), **{phase: 0.0 for phase in PHASES}}
+            stats["count"] += 1
+            stats["seconds"] += total
+            stats["queries"] += timings.queries
+            stats["rows"] += timings.rows
+            for phase, seconds in phases.items():
+                stats[phase] += seconds
+            for index, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    stats["buckets"][index] += 1
+            self._statuses[(endpoint, status)] = self._statuses.get((endpoint, status), 0) + 1
+            for kind in flags:
+                self._flags[kind] = self._flags.get(kind, 0) + 1
+
+    def _dump_profile(self, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, "{}-{}-{}.prof".format(
+            request.endpoint or "unmatched", os.getpid(), time.time_ns()))
+        profile.dump_stats(path)
+        self.profiled += 1
+
+    """
+    prometheus(pool, cache)
+        the metrics of this process in the Prometheus text format, with the
+        pool_stats() of the engines and the stats() of the response cache
+    """
+    def prometheus(self, pool=None, cache=None):
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append("# HELP trivia_{} {}".format(name, help))
+            lines.append("# TYPE trivia_{} {}".format(name, kind))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, label) for key, label in labels)
+                lines.append("trivia_{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+        with self._lock:
+            endpoints = {endpoint: dict(stats, buckets=list(stats["buckets"]))
+                         for endpoint, stats in self._endpoints.items()}
+            statuses = dict(self._statuses)
+            flags = dict(self._flags)
+
+        lines.append("# HELP trivia_request_seconds Request latency.")
+        lines.append("# TYPE trivia_request_seconds histogram")
+        for endpoint, stats in sorted(endpoints.items()):
+            for bound, count in zip(BUCKETS + ("+Inf",), stats["buckets"] + [stats["count"]]):
+                lines.append('trivia_request_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(endpoint, bound, count))
+            lines.append('trivia_request_seconds_count{{endpoint="{}"}} {}'.format(endpoint, stats["count"]))
+            lines.append('trivia_request_seconds_sum{{endpoint="{}"}} {}'.format(endpoint, round(stats["seconds"], 6)))
+
+        metric("requests_total", "counter", "Requests by endpoint and status.",
+               [((("endpoint", endpoint), ("status", status)), count)
+                for (endpoint, status), count in sorted(statuses.items())])
+        metric("request_phase_seconds_total", "counter", "Time spent per phase of the requests.",
+               [((("endpoint", endpoint), ("phase", phase)), round(stats[phase], 6))
+                for endpoint, stats in sorted(endpoints.items()) for phase in PHASES])
+        metric("queries_total", "counter", "SQL queries run by the requests.",
+               [((("endpoint", endpoint),), stats["queries"]) for endpoint, stats in sorted(endpoints.items())])
+        metric("orm_rows_total", "counter", "ORM objects loaded by the requests.",
+               [((("endpoint", endpoint),), stats["rows"]) for endpoint, stats in sorted(endpoints.items())])
+        metric("flagged_requests_total", "counter", "Requests flagged for too many queries or rows, or a full table load.",
+               [((("kind", kind),), count) for kind, count in sorted(flags.items())])
+        metric("profiled_requests_total", "counter", "Requests profiled with cProfile.", [((), self.profiled)])
+
+        if pool is not None:
+            for name, kind in (("checked_out", "gauge"), ("overflow", "gauge"), ("checkouts", "counter"),
+                               ("connects", "counter"), ("timeouts", "counter"), ("waits", "counter"),
+                               ("wait_seconds", "counter")):
+                metric("pool_{}{}".format(name, "_total" if kind == "counter" else ""),
+                       kind, "Connection pool {}.".format(name.replace("_", " ")),
+                       [((("engine", engine),), stats[name]) for engine, stats in sorted(pool.items())])
+        if cache is not None:
+            metric("cache_hits_total", "counter", "Response cache hits.",
+                   [((("endpoint", endpoint),), stats["hits"]) for endpoint, stats in sorted(cache["endpoints"].items())])
+            metric("cache_misses_total", "counter", "Response cache misses.",
+                   [((("endpoint", endpoint),), stats["misses"]) for endpoint, stats in sorted(cache["endpoints"].items())])
+            metric("cache_entries", "gauge", "Response cache entries.", [((), cache["entries"])])
+        return "\n".join(lines) + "\n"
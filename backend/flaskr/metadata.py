@@ -0,0 +1,417 @@
+import bisect
+import copy
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy import func
+
+from models import db, add_write_hook, primary_reads, Question, Category
+
+MAGIC = b"TRVM"
+FORMAT = 1
+HEADER = struct.Struct("<4sIQQQQQ")     # magic, format, categories and questions generations,
+                                        # categories JSON length, groups, ids
+GROUP = struct.Struct("<qqQQ")          # category, difficulty, first id index, id count
+NULL = -1                               # category or difficulty of a NULL column
+LOG_MAGIC = b"TRVL"
+LOG_HEADER = struct.Struct("<4sIQQ")    # magic, format, generations of the file it follows
+RECORD = struct.Struct("<Qqqqq")        # questions generation, action, id, category, difficulty
+INSERT, DELETE = 1, -1
+
+def _padded(length):
+    return (length + 7) // 8 * 8
+
+"""
+MetadataSnapshot
+    a read-only view of a metadata file: the categories map, and the
+    question ids grouped by (category, difficulty), each group sorted,
+    the groups of a category next to each other. The id arrays are
+    memoryviews of the mapped file, shared with every process mapping it.
+"""
+class MetadataSnapshot:
+    def __init__(self, buffer):
+        magic, version, self.categories_generation, self.questions_generation, \
+            categories_length, groups, ids = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError("not a metadata file")
+        self.buffer = buffer
+        offset = HEADER.size
+        self.categories = {int(category_id): category_type for category_id, category_type in
+                           json.loads(bytes(buffer[offset:offset + categories_length])).items()}
+        offset += _padded(categories_length)
+        self.groups = {}        # (category, difficulty) -> (first, count)
+        self.spans = {}         # category -> (first, end)
+        for index in range(groups):
+            category, difficulty, first, count = GROUP.unpack_from(buffer, offset + index * GROUP.size)
+            self.groups[(category, difficulty)] = (first, count)
+            start, end = self.spans.get(category, (first, first))
+            self.spans[category] = (min(start, first), max(end, first + count))
+        offset += groups * GROUP.size
+        self.ids = memoryview(buffer)[offset:offset + ids * 8].cast("q")
+
+    def category_ids(self, category=None):
+        if category is None:
+            return self.ids
+        first, end = self.spans.get(category, (0, 0))
+        return self.ids[first:end]
+
+    def group_ids(self, category, difficulty):
+        first, count = self.groups.get((category, difficulty), (0, 0))
+        return self.ids[first:first + count]
+
+"""
+write_metadata(path, generations, categories, groups)
+    writes a metadata file next to path and renames it over path, so that
+    a process mapping the previous file keeps a consistent view of it.
+    groups is a sorted list of ((category, difficulty), sorted ids).
+"""
+def write_metadata(path, generations, categories, groups):
+    categories_json = json.dumps({str(category_id): category_type for category_id, category_type
+                                  in categories.items()}, sort_keys=True).encode()
+    total = sum(len(ids) for _, ids in groups)
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as output:
+        output.write(HEADER.pack(MAGIC, FORMAT, generations[0], generations[1],
+                                 len(categories_json), len(groups), total))
+        output.write(categories_json.ljust(_padded(len(categories_json)), b"\0"))
+        first = 0
+        for (category, difficulty), ids in groups:
+            output.write(GROUP.pack(category, difficulty, first, len(ids)))
+            first += len(ids)
+        for _, ids in groups:
+            output.write(ids.tobytes() if hasattr(ids, "tobytes") else struct.pack("={}q".format(len(ids)), *ids))
+    os.replace(temporary, path)
+
+"""
+IdSequence
+    the concatenation of id sequences (memoryviews of the file and lists
+    of the write log), read in place
+"""
+class IdSequence:
+    def __init__(self, parts):
+        self.parts = [part for part in parts if len(part)]
+        self.ends = []
+        end = 0
+        for part in self.parts:
+            end += len(part)
+            self.ends.append(end)
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        part = bisect.bisect_right(self.ends, index)
+        return self.parts[part][index - (self.ends[part - 1] if part else 0)]
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+"""
+MetadataView
+    a MetadataSnapshot with the inserts and deletes of the write log
+    applied on top of it, in this process
+"""
+class MetadataView:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.categories = snapshot.categories
+        self.categories_generation = snapshot.categories_generation
+        self.questions_generation = snapshot.questions_generation
+        self.inserted = {}      # (category, difficulty) -> sorted ids not in the file
+        self.deleted = {}       # id in the file -> (category, difficulty)
+        self.entries = 0        # records of the log applied
+        self.log_offset = LOG_HEADER.size
+
+    def copy(self):
+        view = copy.copy(self)
+        view.inserted = {key: list(ids) for key, ids in self.inserted.items()}
+        view.deleted = dict(self.deleted)
+        return view
+
+    def _in_file(self, question_id, key):
+        ids = self.snapshot.group_ids(*key)
+        position = bisect.bisect_left(ids, question_id)
+        return position < len(ids) and ids[position] == question_id
+
+    """
+    apply(generation, action, question_id, key)
+        applies a record of the write log. The file may have been rebuilt
+        between the commit of a write and its record, and already hold
+        it: an insert of an id present or a delete of an id absent is
+        skipped. Returns False when the record contradicts the view.
+    """
+    def apply(self, generation, action, question_id, key):
+        inserted = self.inserted.setdefault(key, [])
+        position = bisect.bisect_left(inserted, question_id)
+        listed = position < len(inserted) and inserted[position] == question_id
+        deleted_key = self.deleted.get(question_id)
+        if deleted_key is not None and deleted_key != key:
+            return False
+        if action == INSERT:
+            if deleted_key is not None:
+                del self.deleted[question_id]
+            elif not listed and not self._in_file(question_id, key):
+                inserted.insert(position, question_id)
+        elif listed:
+            del inserted[position]
+        elif deleted_key is None and self._in_file(question_id, key):
+            self.deleted[question_id] = key
+        self.questions_generation = generation
+        self.entries += 1
+        return True
+
+    def _keys(self, category, difficulty):
+        return {key for key in list(self.snapshot.groups) + list(self.inserted)
+                if (category is None or key[0] == category) and (difficulty is None or key[1] == difficulty)}
+
+    """
+    ids(category, difficulty)
+        the ids of category and difficulty (None for any), the ids of
+        the file first. Ids deleted since the file was written are in it,
+        callers skip the ids in deleted.
+    """
+    def ids(self, category=None, difficulty=None):
+        if difficulty is None:
+            parts = [self.snapshot.category_ids(category)]
+        else:
+            parts = [self.snapshot.group_ids(*key) for key in sorted(self._keys(category, difficulty))]
+        parts.extend(self.inserted[key] for key in sorted(self._keys(category, difficulty)) if key in self.inserted)
+        return IdSequence(parts)
+
+    def groups(self):
+        groups = {key: list(self.snapshot.group_ids(*key)) for key in self.snapshot.groups}
+        for key, ids in self.inserted.items():
+            groups[key] = sorted(groups.get(key, []) + ids)
+        for key in set(self.deleted.values()):
+            groups[key] = [question_id for question_id in groups[key] if question_id not in self.deleted]
+        return sorted((key, ids) for key, ids in groups.items() if ids)
+
+"""
+SharedMetadata
+    the read-mostly metadata of the trivia tables (categories map and
+    question ids per category and difficulty) in a
+    memory-mapped file shared by the worker processes of the host, so
+    that it is built once for all of them instead of once per worker.
+
+    The file records the "categories" and "questions" generations it was
+    built from. An insert or delete in a worker, moving the "questions"
+    generation by one, is appended to a write log next to the file, which
+    every process applies on top of its mapping; once the log holds
+    METADATA_LOG_SIZE records the file is written again with them. A
+    reader seeing other current generations reads the log, maps the file
+    again if it was rewritten, and rebuilds it from the database if it is
+    still stale, one process at a time.
+    Must be registered after the GenerationCounter hook.
+
+    METADATA_PATH      the file, by default one per database in the temp dir
+    METADATA_LOG_SIZE  records of the write log before a rewrite (4096)
+"""
+class SharedMetadata:
+    def __init__(self, app, generations):
+        self.generations = generations
+        uri = app.config.get("SQLALCHEMY_DATABASE_URI", "")
+        self.path = app.config.get("METADATA_PATH") or os.path.join(
+            tempfile.gettempdir(), "trivia-metadata-{}".format(hashlib.sha1(uri.encode()).hexdigest()[:12]))
+        self.log_path = self.path + ".log"
+        self.log_size = app.config.get("METADATA_LOG_SIZE", 4096)
+        self._lock = threading.Lock()
+        self._view = None
+        self._checked = False
+        add_write_hook(app, self.on_write)
+
+    def _current_generations(self):
+        return self.generations.get("categories"), self.generations.get("questions")
+
+    def _fresh(self, view, generations):
+        return view is not None and (view.categories_generation, view.questions_generation) == generations
+
+    def _map(self):
+        try:
+            with open(self.path, "rb") as file:
+                return MetadataSnapshot(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError, struct.error):
+            return None
+
+    """
+    _read()
+        the view of the file and of its write log, reusing the mapping and
+        the records already applied by this process. Holds the file lock,
+        so that no record is read half written.
+    """
+    def _read(self):
+        view = self._view
+        snapshot = self._map()
+        if snapshot is None:
+            return None
+        if view is None or (snapshot.categories_generation, snapshot.questions_generation) != \
+                (view.snapshot.categories_generation, view.snapshot.questions_generation):
+            view = MetadataView(snapshot)
+        try:
+            with open(self.log_path, "rb") as log:
+                header = log.read(LOG_HEADER.size)
+                if len(header) < LOG_HEADER.size or LOG_HEADER.unpack(header) != \
+                        (LOG_MAGIC, FORMAT, snapshot.categories_generation, snapshot.questions_generation):
+                    # The log of another file, its records are in this one
+                    return view
+                log.seek(view.log_offset)
+                records = log.read()
+        except FileNotFoundError:
+            return view
+        if len(records) >= RECORD.size and view is self._view:
+            # The readers of this process keep the current one unchanged
+            view = view.copy()
+        for offset in range(0, len(records) - RECORD.size + 1, RECORD.size):
+            generation, action, question_id, category, difficulty = RECORD.unpack_from(records, offset)
+            if not view.apply(generation, action, question_id, (category, difficulty)):
+                # Rebuilt by the caller
+                self._view = None
+                return None
+            view.log_offset += RECORD.size
+        return view
+
+    def _reset_log(self, generations):
+        temporary = "{}.{}.tmp".format(self.log_path, os.getpid())
+        with open(temporary, "wb") as log:
+            log.write(LOG_HEADER.pack(LOG_MAGIC, FORMAT, generations[0], generations[1]))
+        os.replace(temporary, self.log_path)
+
+    """
+    snapshot()
+        the current MetadataView, read again or rebuilt when stale
+    """
+    def snapshot(self):
+        generations = self._current_generations()
+        view = self._view
+        if self._fresh(view, generations):
+            return view
+        with self._lock, self._file_lock():
+            view = self._read()
+            if not self._checked and self._fresh(view, generations) and not self._matches(view):
+                # The file outlived a restore of the database made outside of
+                # the app, every copy of the tables is stale
+                for table in ("categories", "questions"):
+                    self.generations.bump(table)
+                generations = self._current_generations()
+            self._checked = True
+            if not self._fresh(view, generations):
+                generations = self._current_generations()
+                with primary_reads():
+                    self._build(generations)
+                view = self._read()
+            self._view = view
+        return view
+
+    """
+    _matches(view)
+        checks, once per process, the question and category counts and the
+        last question id of the file against the tables
+    """
+    def _matches(self, view):
+        with primary_reads():
+            questions, last_id = db.session.query(func.count(Question.id), func.max(Question.id)).one()
+            categories = db.session.query(func.count(Category.id)).scalar()
+        ids = [question_id for question_id in view.ids() if question_id not in view.deleted]
+        return (questions, last_id or None, categories) == (len(ids), max(ids, default=None), len(view.categories))
+
+    def _file_lock(self):
+        return _FileLock(self.path + ".lock")
+
+    def _build(self, generations):
+        categories = dict(db.session.query(Category.id, Category.type))
+        query = db.session.query(Question.category, Question.difficulty, Question.id).\
+            order_by(Question.category, Question.difficulty, Question.id)
+        groups = {}
+        for category, difficulty, question_id in query:
+            key = (NULL if category is None else category, NULL if difficulty is None else difficulty)
+            groups.setdefault(key, []).append(question_id)
+        # The SQL order of NULLs depends on the database, the file's does not
+        write_metadata(self.path, generations, categories, sorted(groups.items()))
+        self._reset_log(generations)
+
+    def categories(self):
+        return self.snapshot().categories
+
+    """
+    ids(category, difficulty)
+        an IdSequence of the ids of category (None for all) and difficulty
+        (None for any), read in place from the file, without the deleted()
+        ids filtered out
+    """
+    def ids(self, category=None, difficulty=None):
+        return self.snapshot().ids(category, difficulty)
+
+    """
+    deleted()
+        the ids deleted since the file was written, still in ids()
+    """
+    def deleted(self):
+        return self.snapshot().deleted
+
+    """
+    difficulties(category)
+        the sorted difficulties having questions in category (None for any)
+    """
+    def difficulties(self, category=None):
+        view = self.snapshot()
+        counts = {}
+        for key, (first, count) in view.snapshot.groups.items():
+            counts[key] = counts.get(key, 0) + count
+        for key, ids in view.inserted.items():
+            counts[key] = counts.get(key, 0) + len(ids)
+        for key in view.deleted.values():
+            counts[key] -= 1
+        return sorted({difficulty for (group_category, difficulty), count in counts.items()
+                       if count and difficulty != NULL and (category is None or group_category == category)})
+
+    def on_write(self, table, action, rows):
+        if table != "questions" or action not in ("insert", "delete"):
+            return
+        generations = self._current_generations()
+        with self._lock, self._file_lock():
+            view = self._read()
+            if view is None or (view.categories_generation, view.questions_generation) != \
+                    (generations[0], generations[1] - 1):
+                # Another write came in between, the next reader rebuilds it
+                return
+            records = b"".join(RECORD.pack(
+                generations[1], INSERT if action == "insert" else DELETE, row["id"],
+                NULL if row["category"] is None else row["category"],
+                NULL if row["difficulty"] is None else row["difficulty"]) for row in rows)
+            with open(self.log_path, "ab") as log:
+                log.write(records)
+            view = self._read()
+            if view is None:
+                return
+            if view.entries >= self.log_size:
+                write_metadata(self.path, generations, view.categories, view.groups())
+                self._reset_log(generations)
+                view = self._read()
+            self._view = view
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
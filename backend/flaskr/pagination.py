@@ -0,0 +1,63 @@
+import math
+from sqlalchemy import func
+
+from models import Question
+from .serialization import QUESTION_COLUMNS, QuestionRows
+
+QUESTIONS_PER_PAGE = 10
+
+"""
+count_questions(query)
+    counts the rows matched by a Question query with a single
+    SELECT count(*), dropping any ORDER BY so the database does not sort
+"""
+def count_questions(query):
+    return query.order_by(None).with_entities(func.count(Question.id)).scalar()
+
+"""
+paginated(request, query, total=None)
+    applies the page window of the request to a Question query in SQL.
+
+    ?page=N     offset pagination, LIMIT/OFFSET pushed into the query
+    ?after_id=N keyset pagination, WHERE id > N LIMIT, so a deep page
+                costs the same as the first one
+
+    total can be given as an int, or as a callable returning the count,
+    when the caller has a cheaper way to know it than counting the query;
+    by default the query is counted with count_questions().
+
+    The page is selected as plain QUESTION_COLUMNS rows, current_questions
+    being QuestionRows that jsonify writes as the format() dicts.
+
+    Returns page, total_pages, current_questions, total_questions and the
+    after_id cursor of the next page (None on the last page).
+"""
+def paginated(request, query, total=None):
+    page = request.args.get("page", 1, type=int)
+    after_id = request.args.get("after_id", None, type=int)
+    if page < 1:
+        page = 1
+
+    if total is None:
+        counted = query
+        total = lambda: count_questions(counted)
+
+    query = query.order_by(Question.id)
+    if after_id is not None:
+        query = query.filter(Question.id > after_id)
+    else:
+        query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    # Fetch one row past the page to know whether a next page exists
+    selection = query.with_entities(*QUESTION_COLUMNS).limit(QUESTIONS_PER_PAGE + 1).all()
+    has_next = len(selection) > QUESTIONS_PER_PAGE
+    selection = selection[:QUESTIONS_PER_PAGE]
+
+    if callable(total):
+        total = total()
+    total_pages = math.ceil(total/QUESTIONS_PER_PAGE)
+
+    current_questions = QuestionRows(selection)
+    next_after_id = selection[-1].id if has_next else None
+
+    return page, total_pages, current_questions, total, next_after_id
@@ -0,0 +1,191 @@
+import os
+import queue
+import threading
+import time
+
+from models import db, notify_write, Question, QuestionCount
+
+"""
+PipelineError
+    a write of the pipeline that was not committed, with the reason
+"""
+class PipelineError(Exception):
+    pass
+
+class _Mutation:
+    __slots__ = ("action", "question_id", "values", "done", "row", "error")
+
+    def __init__(self, action, question_id=None, values=None):
+        self.action = action
+        self.question_id = question_id
+        self.values = values
+        self.done = threading.Event()
+        self.row = None
+        self.error = None
+
+"""
+WritePipeline
+    an optional path for the Question writes of the API. The writes of
+    concurrent requests are queued and committed by one thread in groups,
+    one transaction per group instead of one per write: a group is
+    closed WRITE_PIPELINE_WINDOW_MS after its first write, or once it has
+    WRITE_PIPELINE_MAX_BATCH writes.
+
+    Each write runs in a savepoint of the group, so a failing write is
+    reported to its own request and the others still commit. A request
+    gets its row once the group is committed, and the write hooks are
+    called once per group and action. When the commit itself fails, the
+    whole group is retried WRITE_PIPELINE_RETRIES times: a write is
+    acknowledged only once committed, and may be applied twice if a commit
+    that succeeded is reported as failed (at least once).
+
+    WRITE_PIPELINE            route the writes of the API through it (False)
+    WRITE_PIPELINE_WINDOW_MS  group window (5)
+    WRITE_PIPELINE_MAX_BATCH  max writes per group (100)
+    WRITE_PIPELINE_RETRIES    retries of a group whose commit fails (2)
+    WRITE_PIPELINE_TIMEOUT    seconds a request waits for its group (10)
+"""
+class WritePipeline:
+    def __init__(self, app):
+        self.app = app
+        self.window = app.config.get("WRITE_PIPELINE_WINDOW_MS", 5) / 1000
+        self.max_batch = max(app.config.get("WRITE_PIPELINE_MAX_BATCH", 100), 1)
+        self.retries = app.config.get("WRITE_PIPELINE_RETRIES", 2)
+        self.timeout = app.config.get("WRITE_PIPELINE_TIMEOUT", 10)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.groups = 0
+        self.writes = 0
+        self.failed = 0
+
+    def _start(self):
+        # Threads do not survive the fork of a worker, each process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="trivia-write-pipeline", daemon=True).start()
+
+    def _submit(self, mutation):
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.put(mutation)
+        if not mutation.done.wait(self.timeout):
+            raise PipelineError("the write was not committed within {} seconds".format(self.timeout))
+        if mutation.error is not None:
+            raise PipelineError(mutation.error)
+        return mutation.row
+
+    """
+    insert(values), update(question_id, values), delete(question_id)
+        queue a write and wait for its group to commit. Return the
+        format() dict of the question, or raise PipelineError.
+    """
+    def insert(self, values):
+        return self._submit(_Mutation("insert", values=values))
+
+    def update(self, question_id, values):
+        return self._submit(_Mutation("update", question_id, values))
+
+    def delete(self, question_id):
+        return self._submit(_Mutation("delete", question_id))
+
+    def _run(self):
+        while True:
+            group = [self._queue.get()]
+            closes = time.monotonic() + self.window
+            while len(group) < self.max_batch:
+                remaining = closes - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                self._commit(group)
+
+    def _commit(self, group):
+        for attempt in range(self.retries + 1):
+            for mutation in group:
+                mutation.row = mutation.error = None
+            try:
+                deltas = {}
+                for mutation in group:
+                    self._apply(mutation, deltas)
+                deltas = {category: delta for category, delta in deltas.items() if delta}
+                if deltas:
+                    QuestionCount.adjust(deltas)
+                db.session.commit()
+                break
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.warning("write group of %d failed (attempt %d): %s", len(group), attempt + 1, e)
+                error = str(e)
+        else:
+            for mutation in group:
+                mutation.row, mutation.error = None, mutation.error or error
+        db.session.remove()
+
+        committed = [mutation for mutation in group if mutation.row is not None]
+        for action in ("insert", "update", "delete"):
+            rows = [mutation.row for mutation in committed if mutation.action == action]
+            if rows:
+                notify_write("questions", action, rows)
+        self.groups += 1
+        self.writes += len(committed)
+        self.failed += len(group) - len(committed)
+        for mutation in group:
+            mutation.done.set()
+
+    def _apply(self, mutation, deltas):
+        savepoint = db.session.begin_nested()
+        try:
+            if mutation.action == "insert":
+                question = Question(**{field: mutation.values.get(field) for field in
+                                       ("question", "answer", "category", "difficulty")})
+                db.session.add(question)
+            else:
+                question = db.session.get(Question, mutation.question_id)
+                if question is None:
+                    raise PipelineError("question {} does not exist".format(mutation.question_id))
+                previous = question.category
+                if mutation.action == "delete":
+                    db.session.delete(question)
+                else:
+                    for field in ("question", "answer", "category", "difficulty"):
+                        if field in mutation.values:
+                            value = mutation.values[field]
+                            if field in ("category", "difficulty") and value is not None:
+                                value = int(value)
+                            setattr(question, field, value)
+            db.session.flush()
+            row = question.format()
+            savepoint.commit()
+        except PipelineError as e:
+            savepoint.rollback()
+            mutation.error = str(e)
+            return
+        except Exception as e:
+            # e.g. an integrity error of this write alone
+            savepoint.rollback()
+            if not db.session.is_active:
+                raise
+            mutation.error = str(e)
+            return
+        if mutation.action == "insert":
+            deltas[row["category"]] = deltas.get(row["category"], 0) + 1
+        elif mutation.action == "delete":
+            deltas[previous] = deltas.get(previous, 0) - 1
+        elif previous != row["category"]:
+            deltas[previous] = deltas.get(previous, 0) - 1
+            deltas[row["category"]] = deltas.get(row["category"], 0) + 1
+        mutation.row = row
+
+    def stats(self):
+        return {
+            "groups": self.groups,
+            "writes": self.writes,
+            "failed": self.failed,
+            "queued": self._queue.qsize(),
+        }
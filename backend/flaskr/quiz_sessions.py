@@ -0,0 +1,163 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from models import db, Question
+
+"""
+MemorySessionStore
+    quiz sessions of this process in an LRU of at most max_sessions, each
+    expiring ttl seconds after its last use.
+    A session only holds a reference to the shared ordering of its
+    category, a start offset and a cursor.
+"""
+class MemorySessionStore:
+    def __init__(self, max_sessions=10000, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # token -> [ordering, start, cursor, expires]
+
+    def create(self, token, ordering, start, key):
+        with self._lock:
+            self._sessions[token] = [ordering, start, 0, time.monotonic() + self.ttl]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return len(ordering)
+
+    """
+    pop(token)
+        the next question id of the session, None when the session is over.
+        Raises KeyError for an unknown or expired session.
+    """
+    def pop(self, token):
+        with self._lock:
+            session = self._sessions[token]
+            if session[3] < time.monotonic():
+                del self._sessions[token]
+                raise KeyError(token)
+            self._sessions.move_to_end(token)
+            ordering, start, cursor, _ = session
+            session[3] = time.monotonic() + self.ttl
+            if cursor >= len(ordering):
+                return None
+            session[2] = cursor + 1
+            return ordering[(start + cursor) % len(ordering)]
+
+    def delete(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+"""
+RedisSessionStore
+    quiz sessions in a Redis-compatible server shared by every worker.
+    The ordering of a category is stored once as a list, under its
+    category and questions generation, by the first worker needing it;
+    a session is a hash of that list's key, its start offset and a cursor,
+    and each turn increments the cursor and reads the id with LINDEX.
+    Needs the redis package.
+"""
+class RedisSessionStore:
+    def __init__(self, url, ttl=3600):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _ordering(self, key, ordering):
+        # Shared by the sessions of every worker, the first one storing it wins
+        if ordering and not self.redis.exists(key):
+            temporary = "{}:{}".format(key, secrets.token_hex(8))
+            pipeline = self.redis.pipeline()
+            pipeline.rpush(temporary, *ordering)
+            pipeline.renamenx(temporary, key)
+            pipeline.delete(temporary)
+            pipeline.execute()
+        pipeline = self.redis.pipeline()
+        pipeline.llen(key)
+        pipeline.expire(key, self.ttl)
+        return pipeline.execute()[0]
+
+    """
+    create(token, ordering, start, key)
+        a session over the ordering stored under key, returns the number of
+        questions of the stored ordering, which may be another worker's
+    """
+    def create(self, token, ordering, start, key):
+        key = "quiz:ordering:{}".format(key)
+        total = self._ordering(key, ordering)
+        pipeline = self.redis.pipeline()
+        pipeline.hset("quiz:{}".format(token), mapping={
+            "ordering": key, "start": start % total if total else 0, "total": total, "cursor": 0})
+        pipeline.expire("quiz:{}".format(token), self.ttl)
+        pipeline.execute()
+        return total
+
+    def pop(self, token):
+        session = "quiz:{}".format(token)
+        pipeline = self.redis.pipeline()
+        pipeline.expire(session, self.ttl)
+        pipeline.hincrby(session, "cursor", 1)
+        pipeline.hmget(session, "ordering", "start", "total")
+        alive, cursor, (key, start, total) = pipeline.execute()
+        if not alive:
+            # HINCRBY created the hash of the unknown session
+            self.redis.delete(session)
+            raise KeyError(token)
+        if cursor > int(total):
+            return None
+        pipeline = self.redis.pipeline()
+        pipeline.lindex(key, (int(start) + cursor - 1) % int(total))
+        pipeline.expire(key, self.ttl)
+        question_id, _ = pipeline.execute()
+        return int(question_id) if question_id is not None else None
+
+    def delete(self, token):
+        self.redis.delete("quiz:{}".format(token))
+
+"""
+QuizSessions
+    server-side quiz games: start() stores a shuffled order of the
+    questions of a category under a new token and next_question() pops
+    the following id in O(1), so clients do not resend previous_questions.
+
+    Sessions of the same category share the ordering of the sampler and
+    each start at a random offset of it. QUIZ_SESSION_REDIS_URL selects
+    the Redis store, otherwise sessions are kept in process.
+"""
+class QuizSessions:
+    def __init__(self, app, sampler, generations):
+        self.sampler = sampler
+        self.generations = generations
+        ttl = app.config.get("QUIZ_SESSION_TTL", 3600)
+        redis_url = app.config.get("QUIZ_SESSION_REDIS_URL")
+        if redis_url:
+            self.store = RedisSessionStore(redis_url, ttl)
+        else:
+            self.store = MemorySessionStore(app.config.get("QUIZ_SESSION_MAX", 10000), ttl)
+
+    def start(self, category=None):
+        # Read before the ordering, which is then at least as recent
+        key = "{}:{}".format(category, self.generations.get("questions"))
+        ordering = self.sampler.ordering(category)
+        token = secrets.token_urlsafe(16)
+        start = self.sampler.random.randrange(len(ordering)) if ordering else 0
+        total = self.store.create(token, ordering, start, key)
+        return token, total
+
+    """
+    next_question(token)
+        the next Question of the session, None when all were played.
+        Raises KeyError for an unknown or expired session.
+    """
+    def next_question(self, token):
+        while True:
+            question_id = self.store.pop(token)
+            if question_id is None:
+                return None
+            question = db.session.get(Question, question_id)
+            if question is not None:
+                return question
+
+    def end(self, token):
+        self.store.delete(token)
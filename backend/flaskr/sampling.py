@@ -0,0 +1,240 @@
+import random
+import threading
+import time
+from array import array
+
+from models import db, add_write_hook, Question
+
+REJECTION_TRIES = 16
+
+"""
+IdPool
+    an array of question ids with an id -> position map, so adding,
+    removing (swap with the last id) and drawing are all O(1)
+"""
+class IdPool:
+    def __init__(self):
+        self.ids = array("l")
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, question_id):
+        return question_id in self.positions
+
+    def add(self, question_id):
+        if question_id in self.positions:
+            return
+        self.positions[question_id] = len(self.ids)
+        self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def draw(self, rng, seen):
+        return draw_id(self.ids, rng, seen)
+
+"""
+draw_id(ids, rng, seen)
+    a random id of a sequence of ids that is not in seen, or None when
+    every id has been seen. Rejection sampling takes O(1) expected tries
+    while most of the ids are unseen; past REJECTION_TRIES misses the
+    unseen ids are listed.
+"""
+def draw_id(ids, rng, seen):
+    if not len(ids):
+        return None
+    for _ in range(REJECTION_TRIES):
+        question_id = ids[rng.randrange(len(ids))]
+        if question_id not in seen:
+            return question_id
+    unseen = [question_id for question_id in ids if question_id not in seen]
+    return rng.choice(unseen) if unseen else None
+
+"""
+_Excluded
+    the ids a draw skips: the ids seen by the player, and the ids deleted
+    since the shared metadata file was written or found missing here
+"""
+class _Excluded:
+    __slots__ = ("sets",)
+
+    def __init__(self, *sets):
+        self.sets = [ids for ids in sets if ids]
+
+    def __contains__(self, question_id):
+        return any(question_id in ids for ids in self.sets)
+
+"""
+QuestionSampler
+    draws quiz questions from id pools held in memory instead of sorting
+    the candidates with ORDER BY random().
+
+    There is a pool per category, per difficulty and per category and
+    difficulty, None standing for any. The pools are loaded on first use,
+    follow the Question write hooks of this process and are reloaded every
+    QUIZ_POOL_TTL seconds to pick up writes made by other processes. Set
+    QUIZ_RANDOM_SEED for a reproducible sequence of draws.
+    With a SharedMetadata there are no pools: the ids are drawn in place
+    from its id arrays, and the process only keeps the ids found deleted
+    since the metadata was last written.
+"""
+class QuestionSampler:
+    def __init__(self, app, metadata=None):
+        self.metadata = metadata
+        self.random = random.Random(app.config.get("QUIZ_RANDOM_SEED"))
+        self.ttl = app.config.get("QUIZ_POOL_TTL", 60)
+        self._lock = threading.Lock()
+        self._pools = None      # (category id, difficulty), None for any -> IdPool
+        self._keys = {}         # question id -> (category id, difficulty)
+        self._orderings = {}    # category id -> shuffled tuple of ids
+        self._loaded_at = 0
+        self._view = None       # the metadata view the orderings and discarded ids are of
+        self._discarded = set() # ids of the view missing from the table
+        add_write_hook(app, self.on_write)
+
+    def _load(self):
+        self._pools = {(None, None): IdPool()}
+        self._keys = {}
+        self._orderings = {}
+        query = db.session.query(Question.id, Question.category, Question.difficulty).order_by(Question.id)
+        for question_id, category, difficulty in query:
+            self._add(question_id, category, difficulty)
+        self._loaded_at = time.monotonic()
+
+    def _add(self, question_id, category, difficulty):
+        for key in ((None, None), (category, None), (None, difficulty), (category, difficulty)):
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = IdPool()
+            pool.add(question_id)
+        self._keys[question_id] = (category, difficulty)
+
+    """
+    _metadata_view()
+        the current metadata view, forgetting the orderings and discarded
+        ids of the previous one
+    """
+    def _metadata_view(self):
+        view = self.metadata.snapshot()
+        if view is not self._view:
+            with self._lock:
+                if view is not self._view:
+                    self._view = view
+                    self._discarded = set()
+                    self._orderings = {}
+        return view
+
+    def pool(self, category=None, difficulty=None):
+        if self.metadata is not None:
+            # Nothing to load, the metadata holds the ids
+            return self._metadata_view().ids(category, difficulty)
+        with self._lock:
+            if self._pools is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load()
+            return self._pools.get((category, difficulty)) or IdPool()
+
+    """
+    difficulties(category)
+        the sorted difficulties having questions in category
+    """
+    def difficulties(self, category=None):
+        if self.metadata is not None:
+            return self.metadata.difficulties(category)
+        self.pool(category)
+        with self._lock:
+            return sorted(difficulty for (pool_category, difficulty), pool in self._pools.items()
+                          if pool_category == category and difficulty is not None and len(pool))
+
+    """
+    draw(category, previous_questions, difficulty)
+        the id of a random question of category and difficulty (None for
+        any) that is not in previous_questions, or None
+    """
+    def draw(self, category=None, previous_questions=(), difficulty=None):
+        seen = previous_questions if isinstance(previous_questions, set) else set(previous_questions)
+        if self.metadata is not None:
+            view = self._metadata_view()
+            ids = view.ids(category, difficulty)
+            with self._lock:
+                return draw_id(ids, self.random, _Excluded(seen, view.deleted, self._discarded))
+        pool = self.pool(category, difficulty)
+        with self._lock:
+            return pool.draw(self.random, seen)
+
+    """
+    ordering(category)
+        a shuffled tuple of the ids of category, shared by every caller
+        until the next write or reload
+    """
+    def ordering(self, category=None):
+        if self.metadata is not None:
+            view = self._metadata_view()
+            ids = view.ids(category)
+        else:
+            ids = self.pool(category).ids
+        with self._lock:
+            ordering = self._orderings.get(category)
+            if ordering is None:
+                excluded = _Excluded(view.deleted, self._discarded) if self.metadata is not None else ()
+                ordering = [question_id for question_id in ids if question_id not in excluded]
+                self.random.shuffle(ordering)
+                ordering = self._orderings[category] = tuple(ordering)
+            return ordering
+
+    """
+    question(category, previous_questions)
+        draws an id and fetches that single row by primary key
+    """
+    def question(self, category=None, previous_questions=()):
+        seen = set(previous_questions)
+        while True:
+            question_id = self.draw(category, seen)
+            if question_id is None:
+                return None
+            question = db.session.get(Question, question_id)
+            if question is not None:
+                return question
+            # Deleted by another process since the pools were loaded
+            self.discard(question_id)
+            seen.add(question_id)
+
+    def discard(self, question_id):
+        with self._lock:
+            if self.metadata is not None:
+                self._discarded.add(question_id)
+                self._orderings = {}
+                return
+            if self._pools is None:
+                return
+            self._orderings = {}
+            category, difficulty = self._keys.pop(question_id, (None, None))
+            for key in ((None, None), (category, None), (None, difficulty), (category, difficulty)):
+                if key in self._pools:
+                    self._pools[key].remove(question_id)
+
+    def on_write(self, table, action, rows):
+        # The writes reach the metadata through its own hook
+        if table != "questions" or self.metadata is not None:
+            return
+        if action == "bulk":
+            with self._lock:
+                self._pools = None
+                self._orderings = {}
+            return
+        for row in rows:
+            self.discard(row["id"])
+            if action == "delete":
+                continue
+            with self._lock:
+                if self._pools is None:
+                    continue
+                self._add(row["id"], row["category"], row["difficulty"])
+                self._orderings = {}
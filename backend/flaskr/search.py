@@ -0,0 +1,247 @@
+import math
+import threading
+from html import escape
+from flask import current_app
+from sqlalchemy import func, or_, text
+
+from models import db, add_write_hook, primary_reads, Question
+from .pagination import QUESTIONS_PER_PAGE, count_questions
+from .serialization import QUESTION_COLUMNS
+
+SNIPPET_CONTEXT = 40
+
+"""
+trigrams(text)
+    the set of 3-character substrings of a lowercased text
+"""
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+"""
+highlight(text, term)
+    a snippet of text around the first match of term, every match
+    wrapped in <b></b>, the rest of the text HTML escaped
+"""
+def highlight(text, term):
+    lowered = text.lower()
+    term = term.lower()
+    first = lowered.find(term)
+    if first < 0:
+        return None
+    start = max(first - SNIPPET_CONTEXT, 0)
+    end = min(first + len(term) + SNIPPET_CONTEXT, len(text))
+
+    parts = ["..." if start > 0 else ""]
+    position = start
+    match = first
+    while match >= 0 and match + len(term) <= end:
+        parts.append(escape(text[position:match]))
+        parts.append("<b>{}</b>".format(escape(text[match:match + len(term)])))
+        position = match + len(term)
+        match = lowered.find(term, position)
+    parts.append(escape(text[position:end]))
+    parts.append("..." if end < len(text) else "")
+    return "".join(parts)
+
+"""
+highlights(questions, term, fields)
+    {id: snippet} of formatted questions, the snippet of the first of
+    fields matching term
+"""
+def highlights(questions, term, fields):
+    snippets = {}
+    for question in questions:
+        for field in fields:
+            snippet = highlight(question[field] or "", term)
+            if snippet is not None:
+                snippets[question["id"]] = snippet
+                break
+    return snippets
+
+"""
+matching(term, fields)
+    the SQL condition of the questions having term in one of fields, the
+    LIKE wildcards of term escaped, and its pg_trgm similarity rank
+"""
+def matching(term, fields):
+    pattern = "%{}%".format(term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+    columns = [getattr(Question, field) for field in fields]
+    condition = or_(*[column.ilike(pattern, escape="\\") for column in columns])
+    rank = func.greatest(*[func.similarity(column, term) for column in columns]) \
+        if len(columns) > 1 else func.similarity(columns[0], term)
+    return condition, rank
+
+"""
+text_rank(texts, term)
+    the rank of a question of lowercased field texts for a lowercased
+    term, (field, position) of its first match, or None: question text
+    before answer, earlier matches first
+"""
+def text_rank(texts, term):
+    for rank, field_text in enumerate(texts):
+        position = field_text.find(term)
+        if position >= 0:
+            return rank, position
+    return None
+
+"""
+SearchIndex
+    substring search over the question (and optionally the answer) text.
+
+    On PostgreSQL the matching runs in the database, served by a pg_trgm GIN
+    index that PostgreSQL keeps up to date on insert and delete, and the
+    results are ranked by trigram similarity.
+    On other backends, or when pg_trgm is not installed, an in-process
+    trigram inverted index is built on the first search and then updated
+    incrementally from the Question write hooks. It records the
+    "questions" generation it is built from, and is rebuilt when a write
+    of another process moves it.
+"""
+class SearchIndex:
+    def __init__(self, app, generations):
+        self.generations = generations
+        self.fields = ("question", "answer") if app.config.get("SEARCH_ANSWERS") else ("question",)
+        self._use_database = None
+        self._lock = threading.Lock()
+        self._generation = None
+        self._texts = None      # id -> tuple of lowercased field texts
+        self._postings = {}     # trigram -> set of ids
+        add_write_hook(app, self.on_write)
+
+    """
+    use_database
+        whether pg_trgm is installed, looked up once on the first search.
+        The extension and its indexes are created by the migrations.
+    """
+    @property
+    def use_database(self):
+        if self._use_database is None:
+            self._use_database = False
+            if db.engine.dialect.name == "postgresql":
+                try:
+                    self._use_database = db.session.execute(text(
+                        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None
+                except Exception as e:
+                    current_app.logger.warning("pg_trgm is not available, searching in process: %s", e)
+        return self._use_database
+
+    """
+    search(term, page)
+        the page of questions matching term, best matches first.
+        Returns total_pages, current_questions, total_questions and the
+        highlighted snippets keyed by question id.
+    """
+    def search(self, term, page=1):
+        if page < 1:
+            page = 1
+        if self.use_database:
+            total, selection = self._search_database(term, page)
+        else:
+            total, selection = self._search_memory(term, page)
+
+        current_questions = [question.format() for question in selection]
+        total_pages = math.ceil(total/QUESTIONS_PER_PAGE)
+        return total_pages, current_questions, total, highlights(current_questions, term, self.fields)
+
+    def _search_database(self, term, page):
+        query, rank = self._matching(term)
+        total = count_questions(query)
+        selection = query.order_by(rank.desc(), Question.id).\
+            offset((page - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE).all()
+        return total, selection
+
+    def _matching(self, term):
+        condition, rank = matching(term, self.fields)
+        return Question.query.filter(condition), rank
+
+    def _search_memory(self, term, page):
+        ranked = self._ranked_ids(term)
+        total = len(ranked)
+        start = (page - 1) * QUESTIONS_PER_PAGE
+        ids = ranked[start:start + QUESTIONS_PER_PAGE]
+        if not ids:
+            return total, []
+        by_id = {question.id: question for question in Question.query.filter(Question.id.in_(ids))}
+        return total, [by_id[question_id] for question_id in ids if question_id in by_id]
+
+    def _ranked_ids(self, term):
+        term = term.lower()
+        with self._lock:
+            generation = self.generations.get("questions")
+            if self._texts is None or generation != self._generation:
+                self._generation = generation
+                self._build()
+            if len(term) < 3:
+                candidates = self._texts.keys()
+            else:
+                postings = sorted((self._postings.get(gram, set()) for gram in trigrams(term)), key=len)
+                candidates = set.intersection(*postings)
+            ranked = []
+            for question_id in candidates:
+                rank = text_rank(self._texts[question_id], term)
+                if rank is not None:
+                    ranked.append(rank + (question_id,))
+        ranked.sort()
+        return [question_id for _, _, question_id in ranked]
+
+    """
+    stream(term, batch_size)
+        every question matching term as QUESTION_COLUMNS rows, best
+        matches first, read batch_size rows at a time
+    """
+    def stream(self, term, batch_size):
+        if self.use_database:
+            query, rank = self._matching(term)
+            yield from query.with_entities(*QUESTION_COLUMNS).order_by(rank.desc(), Question.id).\
+                execution_options(stream_results=True).yield_per(batch_size)
+            return
+        ranked = self._ranked_ids(term)
+        for start in range(0, len(ranked), batch_size):
+            ids = ranked[start:start + batch_size]
+            by_id = {row.id: row for row in
+                     db.session.query(*QUESTION_COLUMNS).filter(Question.id.in_(ids))}
+            yield from (by_id[question_id] for question_id in ids if question_id in by_id)
+
+    def _build(self):
+        self._texts = {}
+        self._postings = {}
+        columns = [getattr(Question, field) for field in self.fields]
+        with primary_reads():
+            for row in db.session.query(Question.id, *columns):
+                self._add(row[0], row[1:])
+
+    def _add(self, question_id, texts):
+        texts = tuple((field_text or "").lower() for field_text in texts)
+        self._texts[question_id] = texts
+        for field_text in texts:
+            for gram in trigrams(field_text):
+                self._postings.setdefault(gram, set()).add(question_id)
+
+    def _remove(self, question_id):
+        texts = self._texts.pop(question_id, ())
+        for field_text in texts:
+            for gram in trigrams(field_text):
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(question_id)
+                    if not postings:
+                        del self._postings[gram]
+
+    def on_write(self, table, action, rows):
+        if table != "questions" or self._use_database:
+            return
+        with self._lock:
+            if self._texts is None:
+                return
+            # Runs after the GenerationCounter hook: one bump is this write,
+            # more means writes of other processes the index has missed
+            generation = self.generations.get("questions")
+            if action == "bulk" or generation != self._generation + 1:
+                self._texts = None
+                self._postings = {}
+                return
+            self._generation = generation
+            for row in rows:
+                self._remove(row["id"])
+                if action != "delete":
+                    self._add(row["id"], [row[field] for field in self.fields])
@@ -0,0 +1,105 @@
+import json
+import uuid
+from json.encoder import encode_basestring_ascii
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import String
+
+from models import Question
+
+"""
+The columns of Question.format(), selected as plain rows by the list
+endpoints instead of hydrating Question objects.
+"""
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+
+def _string(value):
+    return "null" if value is None else encode_basestring_ascii(value)
+
+def _integer(value):
+    return "null" if value is None else int.__repr__(value)
+
+"""
+row_writer(columns)
+    a function writing a row of columns as the compact JSON object that
+    Flask's provider writes for the dict of the same keys: keys sorted,
+    no spaces, non-ASCII characters escaped
+"""
+def row_writer(columns):
+    keys = [column.key for column in columns]
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    template = "{" + ",".join("{}:%s".format(encode_basestring_ascii(keys[index])) for index in order) + "}"
+    encoders = tuple((index, _string if isinstance(columns[index].type, String) else _integer) for index in order)
+
+    def write(row):
+        return template % tuple([encode(row[index]) for index, encode in encoders])
+    return write
+
+"""
+QuestionRows
+    a list of QUESTION_COLUMNS rows, written by QuestionJSONProvider with
+    the precompiled row writer as the list of the format() dicts
+"""
+class QuestionRows(list):
+    write = staticmethod(row_writer(QUESTION_COLUMNS))
+
+    def format(self):
+        return [dict(zip([column.key for column in QUESTION_COLUMNS], row)) for row in self]
+
+"""
+EncodedQuestions
+    QuestionRows already written as JSON, e.g. read from a snapshot
+"""
+class EncodedQuestions(QuestionRows):
+    write = staticmethod(str)
+
+    def format(self):
+        return [json.loads(text) for text in self]
+
+def _contains_rows(value):
+    if isinstance(value, QuestionRows):
+        return True
+    if isinstance(value, dict):
+        return any(_contains_rows(item) for item in value.values())
+    if isinstance(value, list):
+        return any(_contains_rows(item) for item in value)
+    return False
+
+def _map_rows(value, function):
+    if isinstance(value, QuestionRows):
+        return function(value)
+    if isinstance(value, dict):
+        return {key: _map_rows(item, function) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_map_rows(item, function) for item in value]
+    return value
+
+"""
+QuestionJSONProvider
+    Flask's JSON provider, writing the QuestionRows values of a response
+    body, at any depth, without building a dict per question. The output
+    is the same bytes as for the format() dicts. When the output is not
+    compact, sorted and ASCII (debug mode pretty-prints), the rows are
+    formatted and written by the default provider.
+"""
+class QuestionJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if not _contains_rows(obj):
+            return super().dumps(obj, **kwargs)
+
+        # response() passes the compact separators, debug mode an indent instead
+        compact = kwargs == {"separators": (",", ":")}
+        if not (compact and self.sort_keys and self.ensure_ascii):
+            return super().dumps(_map_rows(obj, lambda rows: rows.format()), **kwargs)
+
+        # Write the body with a placeholder string per list, then splice
+        # the rows written by the row writer in place of the placeholders
+        placeholders = {}
+
+        def placeholder(rows):
+            key = "rows-{}".format(uuid.uuid4().hex)
+            placeholders['"{}"'.format(key)] = "[" + ",".join(map(rows.write, rows)) + "]"
+            return key
+        text = super().dumps(_map_rows(obj, placeholder), **kwargs)
+        for key, rows in placeholders.items():
+            text = text.replace(key, rows, 1)
+        return text
@@ -0,0 +1,474 @@
+import bisect
+import json
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from array import array
+from flask import abort, jsonify, request
+from flask_cors import CORS
+
+from models import db, Question, Category
+from .bulk import validate
+from .decks import MAX_PREFETCH, MODES as DECK_MODES, QuizDecks
+from .pagination import QUESTIONS_PER_PAGE
+from .sampling import draw_id
+from .search import highlight, trigrams
+from .serialization import QUESTION_COLUMNS, EncodedQuestions, QuestionJSONProvider, QuestionRows
+
+MAGIC = b"TRVS"
+FORMAT = 1
+HEADER = struct.Struct("<4sIQQ")        # magic, format, questions, fields searched
+SECTIONS = (
+    "ids",              # int64, question ids in id order; a row is an index in it
+    "category_column",  # int64 per row, -1 for NULL
+    "difficulty_column",# int64 per row, -1 for NULL
+    "json_offsets",     # uint64 per row + 1, into json
+    "json",             # the format() JSON of the rows, as written by the app
+    "text_offsets",     # uint64 per row and searched field + 1, into text
+    "text",             # the lowercased searched fields of the rows, UTF-8
+    "category_map",     # JSON {id: type}
+    "category_rows",    # int64 rows sorted by (category, id)
+    "category_spans",   # int64 (category, first, count) into category_rows
+    "group_ids",        # int64 ids sorted by (category, difficulty, id)
+    "group_spans",      # int64 (category, difficulty, first, count) into group_ids
+    "trigram_offsets",  # uint64 per trigram + 1, into trigrams
+    "trigrams",         # the sorted trigrams of the searched fields, UTF-8
+    "posting_offsets",  # uint64 per trigram + 1, into postings
+    "postings",         # int32 rows of each trigram, sorted
+)
+SECTION = struct.Struct("<QQ")          # offset, length in bytes
+TYPECODES = {"ids": "q", "category_column": "q", "difficulty_column": "q", "json_offsets": "Q",
+             "text_offsets": "Q", "category_rows": "q", "category_spans": "q", "group_ids": "q",
+             "group_spans": "q", "trigram_offsets": "Q", "posting_offsets": "Q", "postings": "i"}
+NULL = -1
+
+def _blob(texts):
+    offsets = array("Q", [0])
+    parts = []
+    for text in texts:
+        encoded = text.encode()
+        parts.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+    return offsets, b"".join(parts)
+
+"""
+build_snapshot(path, search_answers)
+    writes the questions and categories of the database to a snapshot
+    file at path: columnar arrays, the JSON of each question, the
+    category and difficulty indexes and a trigram index of the question
+    text, and of the answers when search_answers is set
+"""
+def build_snapshot(path, search_answers=False):
+    fields = 2 if search_answers else 1
+    write = QuestionRows.write
+    ids, categories, difficulties = array("q"), array("q"), array("q")
+    encoded, texts = [], []
+    postings = {}
+    query = db.session.query(*QUESTION_COLUMNS).order_by(Question.id).\
+        execution_options(stream_results=True).yield_per(1000)
+    for row in query:
+        index = len(ids)
+        ids.append(row.id)
+        categories.append(NULL if row.category is None else row.category)
+        difficulties.append(NULL if row.difficulty is None else row.difficulty)
+        encoded.append(write(row))
+        for text in (row.question, row.answer)[:fields]:
+            text = (text or "").lower()
+            texts.append(text)
+            for gram in trigrams(text):
+                grams = postings.setdefault(gram, array("i"))
+                if not grams or grams[-1] != index:
+                    grams.append(index)
+
+    category_rows = array("q", sorted(range(len(ids)), key=lambda index: (categories[index], ids[index])))
+    category_spans = array("q")
+    for index, row in enumerate(category_rows):
+        if not category_spans or category_spans[-3] != categories[row]:
+            category_spans.extend((categories[row], index, 0))
+        category_spans[-1] += 1
+    grouped = sorted(range(len(ids)), key=lambda index: (categories[index], difficulties[index], ids[index]))
+    group_ids = array("q", (ids[index] for index in grouped))
+    group_spans = array("q")
+    for index, row in enumerate(grouped):
+        if not group_spans or group_spans[-4:-2].tolist() != [categories[row], difficulties[row]]:
+            group_spans.extend((categories[row], difficulties[row], index, 0))
+        group_spans[-1] += 1
+
+    json_offsets, json_blob = _blob(encoded)
+    text_offsets, text_blob = _blob(texts)
+    keys = sorted(postings, key=lambda gram: gram.encode())
+    trigram_offsets, trigram_blob = _blob(keys)
+    posting_offsets = array("Q", [0])
+    for gram in keys:
+        posting_offsets.append(posting_offsets[-1] + len(postings[gram]) * 4)
+    posting_blob = b"".join(postings[gram].tobytes() for gram in keys)
+    category_map = json.dumps({str(category.id): category.type for category in Category.query.order_by(Category.id)})
+
+    sections = [ids.tobytes(), categories.tobytes(), difficulties.tobytes(), json_offsets.tobytes(), json_blob,
+                text_offsets.tobytes(), text_blob, category_map.encode(), category_rows.tobytes(),
+                category_spans.tobytes(), group_ids.tobytes(), group_spans.tobytes(),
+                trigram_offsets.tobytes(), trigram_blob, posting_offsets.tobytes(), posting_blob]
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as output:
+        offset = HEADER.size + SECTION.size * len(SECTIONS)
+        output.write(HEADER.pack(MAGIC, FORMAT, len(ids), fields))
+        for section in sections:
+            output.write(SECTION.pack(offset, len(section)))
+            offset += (len(section) + 7) // 8 * 8
+        for section in sections:
+            output.write(section.ljust((len(section) + 7) // 8 * 8, b"\0"))
+    os.replace(temporary, path)
+    return len(ids)
+
+"""
+QuestionSnapshot
+    a snapshot file mapped in memory. Opening it only reads the header,
+    the categories and the span tables; the columns are memoryviews of the
+    mapping, read in place.
+"""
+class QuestionSnapshot:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size, self.fields = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError("{} is not a trivia snapshot".format(path))
+        view = memoryview(self._map)
+        for index, name in enumerate(SECTIONS):
+            offset, length = SECTION.unpack_from(self._map, HEADER.size + index * SECTION.size)
+            section = view[offset:offset + length]
+            setattr(self, name, section.cast(TYPECODES[name]) if name in TYPECODES else section)
+
+        self.category_map = {int(key): value for key, value in json.loads(bytes(self.category_map)).items()}
+        self.spans = {}         # category -> (first, count) in category_rows
+        spans = self.category_spans
+        for index in range(0, len(spans), 3):
+            self.spans[spans[index]] = (spans[index + 1], spans[index + 2])
+        self.groups = {}        # (category, difficulty) -> (first, count) in group_ids
+        spans = self.group_spans
+        for index in range(0, len(spans), 4):
+            self.groups[(spans[index], spans[index + 1])] = (spans[index + 2], spans[index + 3])
+        self._difficulty_ids = {}
+        self._lock = threading.Lock()
+
+    def row_json(self, row):
+        return str(self.json[self.json_offsets[row]:self.json_offsets[row + 1]], "utf-8")
+
+    def row_of(self, question_id):
+        row = bisect.bisect_left(self.ids, question_id)
+        return row if row < self.size and self.ids[row] == question_id else None
+
+    def total(self, category=None):
+        if category is None:
+            return self.size
+        return self.spans.get(category, (0, 0))[1]
+
+    """
+    page(category, page, after_id)
+        the rows of a page of category (None for all) in id order, and
+        whether a next page exists
+    """
+    def page(self, category=None, page=1, after_id=None):
+        if category is None:
+            first, count = 0, self.size
+            row_at = lambda index: index
+        else:
+            first, count = self.spans.get(category, (0, 0))
+            row_at = lambda index: self.category_rows[first + index]
+        if after_id is not None:
+            # bisect_right over the ids of the rows, without the key= of Python 3.10
+            start, end = 0, count
+            while start < end:
+                middle = (start + end) // 2
+                if self.ids[row_at(middle)] <= after_id:
+                    start = middle + 1
+                else:
+                    end = middle
+        else:
+            start = (page - 1) * QUESTIONS_PER_PAGE
+        rows = [row_at(index) for index in range(start, min(start + QUESTIONS_PER_PAGE, count))]
+        return rows, start + QUESTIONS_PER_PAGE < count
+
+    def _text(self, row, field):
+        index = row * self.fields + field
+        return str(self.text[self.text_offsets[index]:self.text_offsets[index + 1]], "utf-8")
+
+    def _postings(self, gram):
+        key = gram.encode()
+        offsets = self.trigram_offsets
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.trigrams[offsets[middle]:offsets[middle + 1]]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(offsets) - 1 or bytes(self.trigrams[offsets[low]:offsets[low + 1]]) != key:
+            return ()
+        return self.postings[self.posting_offsets[low] // 4:self.posting_offsets[low + 1] // 4]
+
+    """
+    search(term)
+        the rows whose searched fields contain term, ranked like the
+        in-process search index: question before answer, earlier first
+    """
+    def search(self, term):
+        term = term.lower()
+        if len(term) < 3:
+            candidates = range(self.size)
+        else:
+            postings = sorted((self._postings(gram) for gram in trigrams(term)), key=len)
+            candidates = set(postings[0])
+            for rows in postings[1:]:
+                candidates.intersection_update(rows)
+        ranked = []
+        for row in candidates:
+            for field in range(self.fields):
+                position = self._text(row, field).find(term)
+                if position >= 0:
+                    ranked.append((field, position, self.ids[row], row))
+                    break
+        ranked.sort()
+        return [row for _, _, _, row in ranked]
+
+    """
+    The sampler interface of QuizDecks, drawing from the id groups
+    """
+    def draw(self, category=None, previous_questions=(), difficulty=None):
+        seen = previous_questions if isinstance(previous_questions, set) else set(previous_questions)
+        return draw_id(self.group_ids_of(category, difficulty), self.random, seen)
+
+    def difficulties(self, category=None):
+        return sorted({difficulty for (group_category, difficulty) in self.groups
+                       if (category is None or group_category == category) and difficulty != NULL})
+
+    def group_ids_of(self, category, difficulty):
+        if category is not None and difficulty is not None:
+            first, count = self.groups.get((category, difficulty), (0, 0))
+            return self.group_ids[first:first + count]
+        if difficulty is None:
+            spans = [span for (group_category, _), span in self.groups.items()
+                     if category is None or group_category == category]
+            if not spans:
+                return ()
+            first = min(first for first, _ in spans)
+            return self.group_ids[first:max(first + count for first, count in spans)]
+        # The ids of a difficulty over all categories are not contiguous
+        with self._lock:
+            ids = self._difficulty_ids.get(difficulty)
+            if ids is None:
+                ids = self._difficulty_ids[difficulty] = array("q")
+                for (group_category, group_difficulty), (first, count) in sorted(self.groups.items()):
+                    if group_difficulty == difficulty:
+                        ids.extend(self.group_ids[first:first + count])
+            return ids
+
+"""
+append_journal(path, entry)
+    appends a write made in snapshot mode to the journal, one JSON object
+    per line, to be applied to the database with `flask merge-journal`
+"""
+def append_journal(path, entry):
+    line = json.dumps(dict(entry, at=time.time())) + "\n"
+    with open(path, "a", encoding="utf-8") as journal:
+        journal.write(line)
+
+"""
+merge_journal(lines)
+    applies the writes of a journal to the database, in order.
+    Returns the numbers of questions inserted and deleted, and the
+    entries skipped as (line number, reason).
+"""
+def merge_journal(lines):
+    inserted = deleted = 0
+    skipped = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            if entry["action"] == "insert":
+                row = validate(entry["question"], {category.id for category in Category.query})
+                Question(**row).insert()
+                inserted += 1
+            elif entry["action"] == "delete":
+                question = db.session.get(Question, entry["id"])
+                if question is None:
+                    skipped.append((line_number, "question {} does not exist".format(entry["id"])))
+                    continue
+                question.delete()
+                deleted += 1
+            else:
+                skipped.append((line_number, "unknown action {}".format(entry["action"])))
+        except (ValueError, KeyError, TypeError) as e:
+            db.session.rollback()
+            skipped.append((line_number, str(e)))
+    return inserted, deleted, skipped
+
+"""
+serve_snapshot(app)
+    registers on app the read endpoints of the API served from the
+    snapshot file at SNAPSHOT_PATH, without a database: the categories,
+    the question pages, the search and the quizzes. The responses are the
+    ones of the database-backed app.
+    Writes are answered with 405, or appended to SNAPSHOT_JOURNAL when it
+    is set and answered with 202.
+"""
+def serve_snapshot(app):
+    snapshot = QuestionSnapshot(app.config["SNAPSHOT_PATH"])
+    snapshot.random = random.Random(app.config.get("QUIZ_RANDOM_SEED"))
+    decks = QuizDecks(app, snapshot)
+    journal = app.config.get("SNAPSHOT_JOURNAL")
+    app.json = QuestionJSONProvider(app)
+    CORS(app)
+
+    def journaled(entry):
+        if not journal:
+            abort(405)
+        append_journal(journal, entry)
+        return jsonify({"success": True, "journaled": True}), 202
+
+    def page_response(category, fields):
+        # Streaming is left to the database-backed app
+        if request.args.get("stream") is not None:
+            abort(400)
+        page = max(request.args.get("page", 1, type=int), 1)
+        after_id = request.args.get("after_id", None, type=int)
+        rows, has_next = snapshot.page(category, page, after_id)
+        total_questions = snapshot.total(category)
+        return dict(fields, **{
+            "success": True,
+            "total_questions": total_questions,
+            "questions": EncodedQuestions(snapshot.row_json(row) for row in rows),
+            "page": page,
+            "total_pages": math.ceil(total_questions/QUESTIONS_PER_PAGE),
+            "next_after_id": snapshot.ids[rows[-1]] if has_next else None,
+        })
+
+    @app.after_request
+    def after_request(response):
+        response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization,true")
+        response.headers.add("Access-Control-Allow-Methods", "GET,POST,PUT,PATCH,DELETE,OPTIONS")
+        return response
+
+    @app.route("/categories")
+    def get_categories():
+        if not snapshot.category_map:
+            abort(404)
+        body = {
+            "success": True,
+            "categories": snapshot.category_map,
+            "total_categories": len(snapshot.category_map),
+        }
+        if request.args.get("include") == "counts":
+            body["question_counts"] = {category_id: snapshot.total(category_id)
+                                       for category_id in snapshot.category_map}
+            body["total_questions"] = snapshot.total()
+        return jsonify(body)
+
+    @app.route("/questions")
+    def get_questions():
+        if not snapshot.size:
+            abort(404)
+        return jsonify(page_response(None, {"categories": snapshot.category_map}))
+
+    @app.route("/categories/<int:category_id>/questions")
+    def get_questions_by_category(category_id):
+        current_category = snapshot.category_map.get(category_id)
+        if current_category is None:
+            abort(404)
+        return jsonify(page_response(category_id, {"categories": current_category}))
+
+    @app.route("/questions", methods=["POST"])
+    def create_search_question():
+        body = request.get_json()
+        searchTerm = body.get("searchTerm", None)
+        if not searchTerm:
+            try:
+                question = validate(body, snapshot.category_map)
+            except ValueError:
+                abort(422)
+            return journaled({"action": "insert", "question": question})
+
+        page = request.args.get("page", 1, type=int)
+        ranked = snapshot.search(searchTerm)
+        start = (max(page, 1) - 1) * QUESTIONS_PER_PAGE
+        rows = ranked[start:start + QUESTIONS_PER_PAGE]
+        current_questions = EncodedQuestions(snapshot.row_json(row) for row in rows)
+        highlights = {}
+        for question in current_questions.format():
+            for field in ("question", "answer")[:snapshot.fields]:
+                snippet = highlight(question[field] or "", searchTerm)
+                if snippet is not None:
+                    highlights[question["id"]] = snippet
+                    break
+        return jsonify({
+            "success": True,
+            "questions": current_questions,
+            "total_questions": len(ranked),
+            "highlights": highlights,
+            "page": page,
+            "total_pages": math.ceil(len(ranked)/QUESTIONS_PER_PAGE),
+        })
+
+    @app.route("/questions/<int:question_id>", methods=["DELETE"])
+    def delete_question(question_id):
+        if snapshot.row_of(question_id) is None:
+            abort(422)
+        return journaled({"action": "delete", "id": question_id})
+
+    @app.route("/quizzes", methods=["POST"])
+    def play_quizz():
+        body = request.get_json()
+        cat = body.get("quiz_category", None)
+        prev_questions = body.get("previous_questions", None)
+        mode = body.get("mode", "uniform")
+        prefetch = body.get("prefetch", None)
+        if mode not in DECK_MODES:
+            abort(400)
+        try:
+            category = int(cat["id"]) if cat else 0
+            difficulty = body.get("difficulty", None)
+            count = min(max(int(prefetch), 1), MAX_PREFETCH) if prefetch is not None else 1
+            ids = decks.plan(category or None, prev_questions or [], count, mode,
+                             int(difficulty) if difficulty is not None else None,
+                             body.get("distribution", None))
+            if not ids:
+                abort(404)
+            questions = EncodedQuestions(snapshot.row_json(snapshot.row_of(question_id)) for question_id in ids)
+            response = {
+                "success": True,
+                "question": json.loads(questions[0]),
+            }
+            if prefetch is not None:
+                response["questions"] = questions
+            return jsonify(response)
+        except Exception as e:
+            app.logger.warning("%s failed: %s", request.endpoint, e)
+            abort(422)
+
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({"success": False, "error": 400, "message": "bad request"}), 400
+
+    @app.errorhandler(404)
+    def not_found(error):
+        return jsonify({"success": False, "error": 404, "message": "resource not found"}), 404
+
+    @app.errorhandler(405)
+    def not_allowed(error):
+        return jsonify({"success": False, "error": 405, "message": "method not allowed"}), 405
+
+    @app.errorhandler(422)
+    def unprocessable(error):
+        return jsonify({"success": False, "error": 422, "message": "unprocessable"}), 422
+
+    @app.errorhandler(500)
+    def internal_error(error):
+        return jsonify({"success": False, "error": 500, "message": "internal error"}), 500
+
+    return app
@@ -0,0 +1,61 @@
+import threading
+import time
+
+"""
+StartupTimings
+    how long the app took to come up: the import of the package, each
+    phase of create_app, the background warm-up and the time to the
+    first request, in seconds
+"""
+class StartupTimings:
+    def __init__(self, imports):
+        self.imports = imports
+        self.started = self._last = time.perf_counter()
+        self.phases = {}
+        self.warm = None
+        self.warm_errors = []
+        self.first_request = None
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def on_request(self):
+        if self.first_request is None:
+            self.first_request = time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {
+            "imports": round(self.imports, 6),
+            # A list, JSON objects are written with sorted keys
+            "phases": [{"name": phase, "seconds": round(seconds, 6)} for phase, seconds in self.phases.items()],
+            "create_app": round(sum(self.phases.values()), 6),
+            "warm": round(self.warm, 6) if self.warm is not None else None,
+            "warm_errors": self.warm_errors,
+            "first_request": round(self.first_request, 6) if self.first_request is not None else None,
+        }
+
+"""
+warm_up(app, timings, steps)
+    runs the (name, function) steps in a background thread, in an app
+    context, so that the first requests find the caches loaded. A step
+    failing, e.g. while the database is not reachable yet, is logged and
+    left to the first request to load.
+"""
+def warm_up(app, timings, steps):
+    def run():
+        started = time.perf_counter()
+        with app.app_context():
+            for name, step in steps:
+                try:
+                    step()
+                except Exception as e:
+                    timings.warm_errors.append(name)
+                    app.logger.warning("warming %s failed: %s", name, e)
+        timings.warm = time.perf_counter() - started
+        app.logger.info("caches warmed in %.1f ms", timings.warm * 1000)
+
+    thread = threading.Thread(target=run, name="trivia-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,69 @@
+from flask import current_app, stream_with_context
+
+from models import Question
+from .serialization import QUESTION_COLUMNS, QuestionRows
+
+STREAM_FORMATS = ("json", "ndjson")
+STREAM_BATCH_SIZE = 1000
+CHUNK_SIZE = 65536
+
+"""
+question_rows(query, batch_size)
+    the QUESTION_COLUMNS rows of a Question query in id order, read from
+    a server-side cursor batch_size rows at a time
+"""
+def question_rows(query, batch_size=STREAM_BATCH_SIZE):
+    return query.with_entities(*QUESTION_COLUMNS).order_by(Question.id).\
+        execution_options(stream_results=True).yield_per(batch_size)
+
+def _chunks(rows, counter, separator):
+    write = QuestionRows.write
+    buffer = []
+    size = 0
+    for row in rows:
+        text = write(row)
+        buffer.append(text)
+        size += len(text)
+        counter[0] += 1
+        if size >= CHUNK_SIZE:
+            yield separator.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield separator.join(buffer)
+
+"""
+stream_questions(rows, stream_format, fields)
+    a streamed response of every row of rows, written as it is read so
+    that the memory of the request does not grow with the result.
+
+    json    one object, the fields and "success" first, then the
+            "questions" array and "total_questions" once it is known:
+            {"categories":{...},"success":true,"questions":[...],"total_questions":N}
+    ndjson  one question object per line, then a last line with the
+            fields, "success" and "total_questions"
+"""
+def stream_questions(rows, stream_format, fields=None):
+    dumps = current_app.json.dumps
+    fields = dict(fields or {}, success=True)
+
+    def generate():
+        counter = [0]
+        try:
+            if stream_format == "ndjson":
+                for chunk in _chunks(rows, counter, "\n"):
+                    yield chunk + "\n"
+                yield dumps(dict(fields, total_questions=counter[0]), separators=(",", ":")) + "\n"
+            else:
+                yield dumps(fields, separators=(",", ":"))[:-1] + ',"questions":['
+                first = True
+                for chunk in _chunks(rows, counter, ","):
+                    yield chunk if first else "," + chunk
+                    first = False
+                yield '],"total_questions":{}}}\n'.format(counter[0])
+        except Exception:
+            # The status is already sent, the body ends truncated
+            current_app.logger.exception("streaming the questions failed after %d rows", counter[0])
+
+    mimetype = "application/x-ndjson" if stream_format == "ndjson" else "application/json"
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype)
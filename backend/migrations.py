@@ -0,0 +1,235 @@
+from datetime import datetime
+from sqlalchemy import text
+
+from models import db, Category, Question, QuestionCount
+
+"""
+Versioned schema migrations, replacing db.create_all() at startup.
+
+Each migration runs once, in version order, and is recorded in the
+schema_migrations table. Starting the app only reads the last applied
+version, and runs the pending migrations if there are any.
+
+Migrations declared transactional=False run on an autocommit connection,
+for PostgreSQL statements such as CREATE INDEX CONCURRENTLY that cannot
+run in a transaction and do not lock the table against writes.
+Migrations declared optional=False stop the startup when they fail; an
+optional one is logged, recorded in schema_migration_failures and stays
+pending, and is not tried again until `flask migrate --retry-failed`.
+"""
+
+MIGRATIONS = []
+ADVISORY_LOCK_ID = 7211406  # serializes concurrent migrators on PostgreSQL
+
+class Migration:
+    def __init__(self, version, description, apply, transactional=True, optional=False):
+        self.version = version
+        self.description = description
+        self.apply = apply
+        self.transactional = transactional
+        self.optional = optional
+
+def migration(version, description, transactional=True, optional=False):
+    def register(apply):
+        MIGRATIONS.append(Migration(version, description, apply, transactional, optional))
+        MIGRATIONS.sort(key=lambda migration: migration.version)
+        return apply
+    return register
+
+"""
+create_index(connection, name, table, columns, using)
+    CREATE INDEX, CONCURRENTLY on PostgreSQL, where an invalid index left
+    over by an interrupted build is dropped and built again
+"""
+def create_index(connection, name, table, columns, using=None):
+    using = "USING {} ".format(using) if using else ""
+    if connection.dialect.name != "postgresql":
+        connection.execute(text("CREATE INDEX IF NOT EXISTS {} ON {} {}({})".format(name, table, using, columns)))
+        return
+    valid = connection.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name"), {"name": name}).scalar()
+    if valid is False:
+        connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name)))
+    connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}({})".format(
+        name, table, using, columns)))
+
+@migration(1, "questions and categories tables")
+def create_base_tables(connection):
+    db.metadata.create_all(connection, tables=[Category.__table__, Question.__table__])
+
+@migration(2, "question counters")
+def create_question_counts(connection):
+    db.metadata.create_all(connection, tables=[QuestionCount.__table__])
+    if connection.execute(text("SELECT count(*) FROM question_counts")).scalar() == 0:
+        connection.execute(text(
+            "INSERT INTO question_counts (category, count) "
+            "SELECT category, count(*) FROM questions WHERE category IS NOT NULL GROUP BY category"))
+        connection.execute(text(
+            "INSERT INTO question_counts (category, count) SELECT 0, count(*) FROM questions"))
+
+@migration(3, "indexes on questions (category, id) and (difficulty)", transactional=False)
+def create_question_indexes(connection):
+    create_index(connection, "ix_questions_category_id", "questions", "category, id")
+    create_index(connection, "ix_questions_difficulty", "questions", "difficulty")
+
+"""
+category_foreign_keys(connection)
+    the (conname, convalidated, confdeltype) of the foreign keys from
+    questions.category to categories on PostgreSQL, whatever their name:
+    trivia.psql creates one named "category"
+"""
+def category_foreign_keys(connection):
+    return connection.execute(text(
+        "SELECT c.conname, c.convalidated, c.confdeltype FROM pg_constraint c "
+        "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1] "
+        "WHERE c.contype = 'f' AND c.conrelid = 'questions'::regclass "
+        "AND c.confrelid = 'categories'::regclass AND a.attname = 'category' "
+        "AND array_length(c.conkey, 1) = 1 ORDER BY c.conname")).all()
+
+@migration(4, "foreign key from questions.category to categories", transactional=False)
+def create_category_foreign_key(connection):
+    if connection.dialect.name != "postgresql":
+        # SQLite cannot add a constraint; new tables get it from the model
+        return
+    if not category_foreign_keys(connection):
+        # NOT VALID takes no long lock and checks the new rows only, the
+        # existing ones are validated by migration 6
+        connection.execute(text(
+            "ALTER TABLE questions ADD CONSTRAINT fk_questions_category "
+            "FOREIGN KEY (category) REFERENCES categories (id) "
+            "ON UPDATE CASCADE ON DELETE SET NULL NOT VALID"))
+
+@migration(5, "trigram search indexes", transactional=False, optional=True)
+def create_search_indexes(connection):
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    create_index(connection, "ix_questions_question_trgm", "questions", "question gin_trgm_ops", "gin")
+    create_index(connection, "ix_questions_answer_trgm", "questions", "answer gin_trgm_ops", "gin")
+
+@migration(6, "validation of the foreign key from questions.category", transactional=False, optional=True)
+def validate_category_foreign_key(connection):
+    if connection.dialect.name != "postgresql":
+        return
+    pending = [name for name, validated, _ in category_foreign_keys(connection) if not validated]
+    if not pending:
+        return
+    # Questions of a deleted category would fail the validation, the
+    # constraint stays NOT VALID until they are fixed
+    orphans = connection.execute(text(
+        "SELECT id FROM questions q WHERE category IS NOT NULL AND NOT EXISTS "
+        "(SELECT 1 FROM categories c WHERE c.id = q.category) ORDER BY id LIMIT 20")).scalars().all()
+    if orphans:
+        raise ValueError("questions without their category: {}{}".format(
+            ", ".join(str(question_id) for question_id in orphans), "..." if len(orphans) == 20 else ""))
+    # VALIDATE scans without blocking writes
+    for name in pending:
+        connection.execute(text('ALTER TABLE questions VALIDATE CONSTRAINT "{}"'.format(name)))
+
+@migration(7, "one foreign key from questions.category, setting NULL on delete", transactional=False)
+def fix_category_foreign_key(connection):
+    if connection.dialect.name != "postgresql":
+        return
+    keys = category_foreign_keys(connection)
+    names = [name for name, _, _ in keys]
+    if len(keys) > 1 and "fk_questions_category" in names:
+        # Added by migration 4 next to the key of trivia.psql, with NO ACTION
+        # on delete: deleting a category with questions failed
+        connection.execute(text("ALTER TABLE questions DROP CONSTRAINT fk_questions_category"))
+    elif names == ["fk_questions_category"] and keys[0].confdeltype != "n":
+        connection.execute(text(
+            "ALTER TABLE questions DROP CONSTRAINT fk_questions_category, "
+            "ADD CONSTRAINT fk_questions_category FOREIGN KEY (category) REFERENCES categories (id) "
+            "ON UPDATE CASCADE ON DELETE SET NULL NOT VALID"))
+        if keys[0].convalidated:
+            connection.execute(text("ALTER TABLE questions VALIDATE CONSTRAINT fk_questions_category"))
+
+def _ensure_version_table(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations "
+        "(version INTEGER PRIMARY KEY, description VARCHAR, applied_at TIMESTAMP)"))
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migration_failures "
+        "(version INTEGER PRIMARY KEY, error VARCHAR, failed_at TIMESTAMP)"))
+
+def applied_versions(connection):
+    _ensure_version_table(connection)
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+def failed_versions(connection):
+    _ensure_version_table(connection)
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_migration_failures"))}
+
+"""
+pending_migrations(engine, retry_failed)
+    the migrations not applied yet to the database of engine, without
+    the optional ones that failed unless retry_failed
+"""
+def pending_migrations(engine, retry_failed=True):
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+        failed = set() if retry_failed else failed_versions(connection)
+    return [migration for migration in MIGRATIONS
+            if migration.version not in applied and migration.version not in failed]
+
+def _apply(engine, migration):
+    if migration.transactional:
+        with engine.begin() as connection:
+            migration.apply(connection)
+            _record(connection, migration)
+    else:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            migration.apply(connection)
+            _record(connection, migration)
+
+def _record(connection, migration):
+    connection.execute(text(
+        "INSERT INTO schema_migrations (version, description, applied_at) VALUES (:version, :description, :now)"),
+        {"version": migration.version, "description": migration.description, "now": datetime.utcnow()})
+    connection.execute(text("DELETE FROM schema_migration_failures WHERE version = :version"),
+                       {"version": migration.version})
+
+def _record_failure(engine, migration, error):
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM schema_migration_failures WHERE version = :version"),
+                           {"version": migration.version})
+        connection.execute(text(
+            "INSERT INTO schema_migration_failures (version, error, failed_at) VALUES (:version, :error, :now)"),
+            {"version": migration.version, "error": str(error)[:1000], "now": datetime.utcnow()})
+
+"""
+migrate(engine, retry_failed)
+    applies the pending migrations, holding a PostgreSQL advisory lock so
+    that workers starting together do not run them twice. The optional
+    migrations that failed before are skipped, unless retry_failed, so
+    that a known failure does not hold the lock at every start.
+    Returns the versions applied.
+"""
+def migrate(engine, log=print, retry_failed=False):
+    pending = pending_migrations(engine, retry_failed)
+    if not pending:
+        return []
+
+    applied = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        if engine.dialect.name == "postgresql":
+            lock.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        try:
+            # Another worker may have applied them while we waited for the lock
+            for migration in pending_migrations(engine, retry_failed):
+                try:
+                    _apply(engine, migration)
+                except Exception as e:
+                    if not migration.optional:
+                        raise
+                    _record_failure(engine, migration, e)
+                    log("migration {} ({}) failed and stays pending until `flask migrate --retry-failed`: {}".format(
+                        migration.version, migration.description, e))
+                    continue
+                log("applied migration {}: {}".format(migration.version, migration.description))
+                applied.append(migration.version)
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+    return applied
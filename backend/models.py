@@ -1,28 +1,230 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, ForeignKey, Index, String, Integer, create_engine, event, func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import NullPool, QueuePool
+from flask import current_app, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 import json
 
 #DB_NAME = os.environ.get('DATABASE', 'trivia')
 #DB_USER = os.environ.get('USERNAME', 'student')
 #DB_PASSWORD = os.environ.get('PASSWORD', 'student')
 #DB_HOST = os.environ.get('HOST', 'localhost:5432')
-db_path = "postgresql://{}:{}@{}/{}".format('lieke', 'Glen2865', 'localhost:5432', 'trivia')
+db_path = os.environ.get("DATABASE_URL") or \
+    "postgresql://{}:{}@{}/{}".format('lieke', 'Glen2865', 'localhost:5432', 'trivia')
 
-db = SQLAlchemy()
+"""
+MeteredQueuePool
+    a QueuePool counting how long checkouts wait for a free connection
+"""
+class MeteredQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            self.metrics.waited(time.perf_counter() - started)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.waits = 0          # checkouts that waited over 1 ms
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def waited(self, seconds):
+        with self._lock:
+            if seconds > 0.001:
+                self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+_routing = threading.local()
+
+"""
+primary_reads()
+    a context in which the reads of GET and HEAD requests go to the
+    primary too. For the copies of the tables tagged with a generation: a
+    replica lagging behind the write that moved the generation would be
+    cached as current until the next write.
+"""
+@contextmanager
+def primary_reads():
+    previous = getattr(_routing, "primary", False)
+    _routing.primary = True
+    try:
+        yield
+    finally:
+        _routing.primary = previous
+
+"""
+RoutingSession
+    sends the reads of GET and HEAD requests to the "replica" bind, when
+    DB_REPLICA_URL is configured, and everything else, or within
+    primary_reads(), to the primary
+"""
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and "replica" in self._db.engines \
+                and not getattr(_routing, "primary", False) \
+                and has_request_context() and request.method in ("GET", "HEAD"):
+            return self._db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+"""
+engine_options(app)
+    the SQLAlchemy engine and pool options from the app config:
+
+    DB_POOL_SIZE          connections kept open per process (5)
+    DB_MAX_OVERFLOW       connections opened past the pool size (10)
+    DB_POOL_TIMEOUT       seconds to wait for a connection (30)
+    DB_POOL_RECYCLE       seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING      test connections on checkout, after failovers (True)
+    DB_STATEMENT_TIMEOUT  PostgreSQL statement_timeout in milliseconds
+    DB_PGBOUNCER          behind PgBouncer in transaction mode: no pool in
+                          the app, and settings sent with SET on connect
+"""
+def engine_options(app):
+    options = {"pool_pre_ping": app.config.get("DB_POOL_PRE_PING", True)}
+    if app.config.get("DB_PGBOUNCER"):
+        options["poolclass"] = NullPool
+    elif not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        options.update({
+            "poolclass": MeteredQueuePool,
+            "pool_size": app.config.get("DB_POOL_SIZE", 5),
+            "max_overflow": app.config.get("DB_MAX_OVERFLOW", 10),
+            "pool_timeout": app.config.get("DB_POOL_TIMEOUT", 30),
+            "pool_recycle": app.config.get("DB_POOL_RECYCLE", 1800),
+        })
+    statement_timeout = app.config.get("DB_STATEMENT_TIMEOUT")
+    if statement_timeout and not app.config.get("DB_PGBOUNCER"):
+        options["connect_args"] = {"options": "-c statement_timeout={}".format(int(statement_timeout))}
+    return options
+
+def _instrument(engine, statement_timeout=None):
+    metrics = getattr(engine.pool, "metrics", None) or PoolMetrics()
+    engine.pool_metrics = metrics
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.checkouts += 1
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        metrics.checkins += 1
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        metrics.connects += 1
+        if statement_timeout:
+            # PgBouncer rejects startup options, the timeout is set per session
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SET statement_timeout = {}".format(int(statement_timeout)))
+            cursor.close()
+
+    @event.listens_for(engine, "invalidate")
+    def invalidate(dbapi_connection, connection_record, exception):
+        metrics.invalidations += 1
+
+"""
+pool_stats()
+    the pool metrics of each engine, keyed "primary" and "replica"
+"""
+def pool_stats():
+    stats = {}
+    for key, engine in db.engines.items():
+        pool = engine.pool
+        metrics = engine.pool_metrics
+        stats["primary" if key is None else key] = {
+            "pool": pool.__class__.__name__,
+            "size": pool.size() if hasattr(pool, "size") else 0,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else 0,
+            "overflow": max(pool.overflow(), 0) if hasattr(pool, "overflow") else 0,
+            "checkouts": metrics.checkouts,
+            "checkins": metrics.checkins,
+            "connects": metrics.connects,
+            "invalidations": metrics.invalidations,
+            "timeouts": metrics.timeouts,
+            "waits": metrics.waits,
+            "wait_seconds": round(metrics.wait_seconds, 6),
+            "max_wait_seconds": round(metrics.max_wait_seconds, 6),
+        }
+    return stats
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with the engine
+    options of engine_options() and, when DB_REPLICA_URL is set, a
+    read replica used by the GET requests.
+    SCHEMA_MODE picks the schema work done at startup: "migrate" (the
+    default) applies the pending migrations of migrations.py, "create_all"
+    creates the missing tables as before, and "skip" does not look at the
+    schema at all, for deployments that run `flask migrate` on release.
 """
-def setup_db(app, database_path=db_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    if database_path is not None or "SQLALCHEMY_DATABASE_URI" not in app.config:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path or db_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app))
+    if app.config.get("DB_REPLICA_URL"):
+        app.config.setdefault("SQLALCHEMY_BINDS", {})["replica"] = app.config["DB_REPLICA_URL"]
     db.app = app
     db.init_app(app)
     with app.app_context():
-        db.create_all()
+        statement_timeout = app.config.get("DB_STATEMENT_TIMEOUT") if app.config.get("DB_PGBOUNCER") else None
+        for engine in db.engines.values():
+            _instrument(engine, statement_timeout)
+        schema_mode = app.config.get("SCHEMA_MODE", "migrate")
+        if schema_mode == "migrate":
+            from migrations import migrate
+            migrate(db.engine, log=app.logger.info)
+        elif schema_mode == "create_all":
+            db.create_all()
+            QuestionCount.ensure()
+
+"""
+add_write_hook(app, hook)
+    registers hook(table, action, rows) to run after a write to the
+    questions or categories table has been committed, so the in-process
+    indexes built by the app can follow the table.
+    action is "insert", "update" or "delete" and rows are format() dicts,
+    or action is "bulk" with no rows after a bulk load, and the indexes
+    are rebuilt from the table.
+"""
+def add_write_hook(app, hook):
+    app.extensions.setdefault("trivia_write_hooks", []).append(hook)
+
+def notify_write(table, action, rows):
+    for hook in current_app.extensions.get("trivia_write_hooks", []):
+        try:
+            hook(table, action, rows)
+        except Exception:
+            # The write is already committed, a stale index must not fail it
+            current_app.logger.exception("write hook failed on %s %s", action, table)
 
 """
 Question
@@ -30,29 +232,49 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    # Created by the migrations on existing databases
+    __table_args__ = (
+        Index("ix_questions_category_id", "category", "id"),
+        Index("ix_questions_difficulty", "difficulty"),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(Integer) #It was String
+    category = Column(Integer, ForeignKey("categories.id", name="fk_questions_category",
+                                          onupdate="CASCADE", ondelete="SET NULL")) #It was String
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
-        self.category = category
-        self.difficulty = difficulty
+        # Forms post numbers as strings, the write hooks expect the column types
+        self.category = int(category) if category is not None else None
+        self.difficulty = int(difficulty) if difficulty is not None else None
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        row = self.format()
+        QuestionCount.adjust({self.category: 1})
         db.session.commit()
+        notify_write("questions", "insert", [row])
 
     def update(self):
+        history = inspect(self).attrs.category.history
+        if history.deleted and history.added:
+            QuestionCount.adjust({history.deleted[0]: -1, history.added[0]: 1})
+        db.session.flush()
+        row = self.format()
         db.session.commit()
+        notify_write("questions", "update", [row])
 
     def delete(self):
+        row = self.format()
         db.session.delete(self)
+        QuestionCount.adjust({self.category: -1})
         db.session.commit()
+        notify_write("questions", "delete", [row])
 
     def format(self):
         return {
@@ -76,8 +298,119 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        db.session.flush()
+        row = self.format()
+        db.session.commit()
+        notify_write("categories", "insert", [row])
+
+    def update(self):
+        db.session.flush()
+        row = self.format()
+        db.session.commit()
+        notify_write("categories", "update", [row])
+
+    def delete(self):
+        row = self.format()
+        db.session.delete(self)
+        db.session.commit()
+        notify_write("categories", "delete", [row])
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
             }
+
+"""
+QuestionCount
+    the number of questions per category, and of all the questions in the
+    ALL_CATEGORIES row, updated in the transaction of each Question write.
+    rebuild() recounts the table after writes made outside the models.
+"""
+ALL_CATEGORIES = 0
+
+class QuestionCount(db.Model):
+    __tablename__ = 'question_counts'
+
+    category = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    """
+    adjust(deltas)
+        adds {category: delta} to the counters, and their sum to the
+        ALL_CATEGORIES counter, in the current transaction
+    """
+    @staticmethod
+    def adjust(deltas):
+        table = QuestionCount.__table__
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            for upsert in QuestionCount.upserts(deltas, dialect):
+                db.session.execute(upsert)
+            return
+        for category, delta in QuestionCount._with_total(deltas).items():
+            if delta:
+                updated = db.session.execute(table.update().where(table.c.category == category).
+                                             values(count=table.c.count + delta))
+                if not updated.rowcount:
+                    db.session.execute(table.insert().values(category=category, count=delta))
+
+    @staticmethod
+    def _with_total(deltas):
+        deltas = dict(deltas)
+        total = sum(deltas.values())
+        # A question without a category only counts in the total, like in rebuild()
+        deltas.pop(None, None)
+        deltas[ALL_CATEGORIES] = deltas.get(ALL_CATEGORIES, 0) + total
+        return deltas
+
+    """
+    upserts(deltas, dialect)
+        the INSERT ... ON CONFLICT statements of adjust() on PostgreSQL and
+        SQLite, for callers running them on their own connection
+    """
+    @staticmethod
+    def upserts(deltas, dialect):
+        table = QuestionCount.__table__
+        statements = []
+        for category, delta in QuestionCount._with_total(deltas).items():
+            if not delta:
+                continue
+            upsert = (postgresql if dialect == "postgresql" else sqlite).insert(table).\
+                values(category=category, count=delta)
+            statements.append(upsert.on_conflict_do_update(
+                index_elements=[table.c.category],
+                set_={"count": table.c.count + upsert.excluded.count}))
+        return statements
+
+    @staticmethod
+    def counts():
+        return dict(db.session.query(QuestionCount.category, QuestionCount.count))
+
+    """
+    rebuild()
+        recounts the questions with one GROUP BY and replaces the counters
+    """
+    @staticmethod
+    def rebuild():
+        table = QuestionCount.__table__
+        counts = dict(db.session.query(Question.category, func.count(Question.id)).group_by(Question.category))
+        counts.pop(None, None)
+        counts[ALL_CATEGORIES] = db.session.query(func.count(Question.id)).scalar()
+        db.session.execute(table.delete())
+        db.session.execute(table.insert(), [{"category": category, "count": count}
+                                            for category, count in counts.items()])
+        db.session.commit()
+        return counts
+
+    """
+    ensure()
+        rebuilds the counters if they were never built
+    """
+    @staticmethod
+    def ensure():
+        if db.session.get(QuestionCount, ALL_CATEGORIES) is None:
+            QuestionCount.rebuild()
+
@@ -1,11 +1,19 @@
+import asyncio
 import os
+import tempfile
 from dotenv import load_dotenv
 import unittest
 import json
 from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import db, setup_db, Question, Category
+from flaskr.asgi import create_async_app
+from models import db, setup_db, Question, Category, QuestionCount
+from migrations import pending_migrations
+from flask import jsonify
+from flaskr.metadata import DELETE, INSERT, MetadataSnapshot, MetadataView, write_metadata
+from flaskr.serialization import QUESTION_COLUMNS, QuestionRows
+from flaskr.snapshot import build_snapshot
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
@@ -38,6 +46,19 @@ class TriviaTestCase(unittest.TestCase):
         """Executed after reach test"""
         pass
 
+    def async_responses(self, requests):
+        """Sends (method, url, json) requests to the ASGI app on the same database, returns their status and JSON"""
+        async def send():
+            app = create_async_app({"SQLALCHEMY_DATABASE_URI": self.database_path})
+            client = app.test_client()
+            responses = []
+            for method, url, body in requests:
+                res = await (client.get(url) if method == "GET" else client.post(url, json=body))
+                responses.append((res.status_code, await res.get_json()))
+            await app.config["ASYNC_ENGINE"].dispose()
+            return responses
+        return asyncio.run(send())
+
     """
     TODO
     Write at least one test for each test for successful operation and for expected errors.
@@ -50,6 +71,38 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["questions"])
         self.assertTrue(len(data["categories"]))
 
+    def test_get_questions_not_modified(self):
+        res = self.client().get("/questions")
+        self.assertTrue(res.headers["Last-Modified"])
+        res = self.client().get("/questions", headers={"If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res.status_code, 304)
+
+    def test_cache_stats(self):
+        self.client().get("/questions?page=1")
+        self.client().get("/questions?page=1")
+        res = self.client().get("/cache/stats")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["hits"])
+        self.assertTrue(data["misses"])
+
+    def test_pool_stats(self):
+        self.client().get("/questions")
+        res = self.client().get("/metrics/pool")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["engines"]["primary"]["checkouts"])
+
+    def test_get_questions_after_id(self):
+        res = self.client().get("/questions?after_id=10")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(all(question["id"] > 10 for question in data["questions"]))
+        self.assertLessEqual(len(data["questions"]), 10)
+
     def test_delete_question(self):
         with self.app.app_context():
             res = self.client().delete("/questions/6")
@@ -79,12 +132,38 @@ class TriviaTestCase(unittest.TestCase):
         res = self.client().post("/questions", json=self.new_question)
         data = json.loads(res.data)
 
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["created"])
+        self.assertEqual(data["question"]["id"], data["created"])
+        self.assertNotIn("questions", data)
+        self.assertTrue(data["total_questions"])
+
+    def test_create_new_question_include_page(self):
+        res = self.client().post("/questions?include=page", json=self.new_question)
+        data = json.loads(res.data)
+
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
         self.assertTrue(data["created"])
         self.assertTrue(len(data["questions"]))
         self.assertTrue(data["total_questions"])
     
+    def test_bulk_import_questions(self):
+        body = "\n".join([json.dumps(self.new_question), json.dumps({"question": "No answer"})])
+        res = self.client().post("/questions/import", data=body, content_type="application/x-ndjson")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["imported"], 1)
+        self.assertEqual(data["failed"], 1)
+        self.assertEqual(data["errors"][0]["line"], 2)
+
+    def test_bulk_export_questions(self):
+        res = self.client().get("/questions/export")
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(json.loads(line)["id"] for line in res.data.decode().splitlines()))
+
     def test_405_if_create_question_not_allowed(self):
         res = self.client().post("/questions/1000", json=self.new_question)
         data = json.loads(res.data)
@@ -100,6 +179,36 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["total_categories"])
         self.assertTrue(len(data["categories"]))
 
+    def test_get_categories_not_modified(self):
+        res = self.client().get("/categories")
+        etag = res.headers["ETag"]
+        res = self.client().get("/categories", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+
+    def test_get_categories_with_counts(self):
+        res = self.client().get("/categories?include=counts")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(set(data["question_counts"]), set(data["categories"]))
+        self.assertEqual(sum(data["question_counts"].values()), data["total_questions"])
+
+    def test_counters_of_question_without_category(self):
+        res = self.client().get("/categories?include=counts")
+        before = json.loads(res.data)
+        res = self.client().post("/questions", json={"question": "Uncategorized?", "answer": "Yes", "difficulty": 1})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get("/categories?include=counts")
+        after = json.loads(res.data)
+        self.assertEqual(after["total_questions"], before["total_questions"] + 1)
+        self.assertEqual(after["question_counts"], before["question_counts"])
+        with self.app.app_context():
+            self.assertNotIn(None, QuestionCount.counts())
+        self.client().delete("/questions/{}".format(data["created"]))
+
     def test_get_questions_by_category(self):
         res = self.client().get("/categories/1/questions")
         data = json.loads(res.data)
@@ -122,6 +231,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertEqual(len(data["questions"]), 0)
 
+    def test_search_questions_highlights(self):
+        res = self.client().post("/questions", json={"searchTerm": "title"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["highlights"]), len(data["questions"]))
+        for snippet in data["highlights"].values():
+            self.assertIn("<b>title</b>", snippet.lower())
+
     def test_search_questions_without_result(self):
         res = self.client().post("/questions", json={"searchTerm": "test2"})
         data = json.loads(res.data)
@@ -130,12 +248,226 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data["questions"]), 0)
 
     def test_quizz(self):
-        res = self.client().post("/questions", json={"previous_questions":[12], "quiz_category":{"type":"click", "id":"0"}})
+        res = self.client().post("/questions?include=page", json={"previous_questions":[12], "quiz_category":{"type":"click", "id":"0"}})
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
+        self.assertTrue(data["created"])
         self.assertTrue(data["questions"])
 
+    def test_quiz_excludes_previous_questions(self):
+        res = self.client().post("/quizzes", json={"previous_questions": [5, 9, 12], "quiz_category": {"type": "History", "id": "4"}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["question"]["category"], 4)
+        self.assertNotIn(data["question"]["id"], [5, 9, 12])
+
+    def test_quiz_prefetch_escalating(self):
+        res = self.client().post("/quizzes", json={"previous_questions": [], "quiz_category": {"type": "click", "id": 0},
+                                                   "mode": "escalating", "prefetch": 5})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["questions"]), 5)
+        self.assertEqual(data["question"], data["questions"][0])
+        difficulties = [question["difficulty"] for question in data["questions"]]
+        self.assertEqual(difficulties, sorted(difficulties))
+
+    def test_400_quiz_unknown_mode(self):
+        res = self.client().post("/quizzes", json={"previous_questions": [], "mode": "random"})
+        self.assertEqual(res.status_code, 400)
+
+    def test_quiz_session(self):
+        res = self.client().post("/quizzes/sessions", json={"quiz_category": {"type": "History", "id": "4"}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["session"])
+
+        played = []
+        for _ in range(data["total_questions"]):
+            res = self.client().post("/quizzes/sessions/{}/next".format(data["session"]))
+            question = json.loads(res.data)["question"]
+            if question is not None:
+                played.append(question["id"])
+        self.assertEqual(len(played), len(set(played)))
+
+    def test_404_quiz_session_not_exist(self):
+        res = self.client().post("/quizzes/sessions/unknown/next")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+
+    def test_server_timing_and_metrics(self):
+        res = self.client().get("/questions")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("db;dur=", res.headers["Server-Timing"])
+        self.assertIn("X-Query-Count", res.headers)
+
+        res = self.client().get("/metrics")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint="get_questions",status="200"}', res.get_data(as_text=True))
+
+    def test_question_rows_written_as_format(self):
+        with self.app.app_context():
+            questions = Question.query.order_by(Question.id).limit(10).all()
+            rows = Question.query.with_entities(*QUESTION_COLUMNS).order_by(Question.id).limit(10).all()
+            self.assertEqual(
+                jsonify({"questions": QuestionRows(rows)}).get_data(),
+                jsonify({"questions": [question.format() for question in questions]}).get_data())
+
+    def test_stream_questions(self):
+        res = self.client().get("/questions?stream=json")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["questions"]), data["total_questions"])
+
+        res = self.client().get("/categories/1/questions?stream=ndjson")
+        lines = [json.loads(line) for line in res.data.decode().splitlines()]
+        self.assertEqual(lines[-1]["total_questions"], len(lines) - 1)
+
+    def test_400_stream_format(self):
+        res = self.client().get("/questions?stream=xml")
+        self.assertEqual(res.status_code, 400)
+
+    def test_shared_metadata_follows_writes(self):
+        res = self.client().get("/categories?include=counts")
+        before = json.loads(res.data)["question_counts"]["1"]
+        res = self.client().post("/questions", json={"question": "What is H2O?", "answer": "Water", "difficulty": 1, "category": 1})
+        created = json.loads(res.data)["created"]
+
+        res = self.client().get("/categories?include=counts")
+        self.assertEqual(json.loads(res.data)["question_counts"]["1"], before + 1)
+        self.client().delete("/questions/{}".format(created))
+        res = self.client().get("/categories?include=counts")
+        self.assertEqual(json.loads(res.data)["question_counts"]["1"], before)
+
+    def test_metadata_log_skips_writes_already_in_the_file(self):
+        path = os.path.join(tempfile.mkdtemp(), "metadata")
+        write_metadata(path, (0, 1), {1: "Science"}, [((1, 1), [5, 7])])
+        with open(path, "rb") as file:
+            view = MetadataView(MetadataSnapshot(file.read()))
+        # Records of writes the file was rebuilt with
+        self.assertTrue(view.apply(2, INSERT, 7, (1, 1)))
+        self.assertTrue(view.apply(3, DELETE, 9, (1, 1)))
+        self.assertEqual(list(view.ids(1)), [5, 7])
+        self.assertEqual(view.deleted, {})
+        self.assertTrue(view.apply(4, DELETE, 5, (1, 1)))
+        self.assertEqual(view.groups(), [((1, 1), [7])])
+
+    def test_migrations_applied(self):
+        with self.app.app_context():
+            pending = pending_migrations(db.engine)
+            self.assertEqual([migration for migration in pending if not migration.optional], [])
+
+    def test_snapshot_serves_same_questions(self):
+        path = os.path.join(tempfile.mkdtemp(), "trivia.snapshot")
+        with self.app.app_context():
+            build_snapshot(path)
+        snapshot_app = create_app({"SNAPSHOT_PATH": path})
+        for url in ("/categories", "/questions?page=2", "/categories/1/questions"):
+            res = snapshot_app.test_client().get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, self.client().get(url).data)
+        res = snapshot_app.test_client().post("/quizzes", json={"quiz_category": {"id": 1}, "previous_questions": []})
+        self.assertEqual(json.loads(res.data)["question"]["category"], 1)
+
+    def test_405_snapshot_write_without_journal(self):
+        path = os.path.join(tempfile.mkdtemp(), "trivia.snapshot")
+        with self.app.app_context():
+            build_snapshot(path)
+        res = create_app({"SNAPSHOT_PATH": path}).test_client().post("/questions", json=self.new_question)
+        self.assertEqual(res.status_code, 405)
+        self.assertEqual(json.loads(res.data)["success"], False)
+
+    def test_429_rate_limited(self):
+        app = create_app({"ADMISSION_LIMITS": {"get_admission_stats": (1, 1)}})
+        res = app.test_client().get("/metrics/admission")
+        self.assertEqual(res.status_code, 200)
+        res = app.test_client().get("/metrics/admission")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data["success"], False)
+        self.assertTrue(res.headers["Retry-After"])
+
+    def test_batch_pages_and_quiz(self):
+        res = self.client().post("/batch", json={"operations": [
+            {"op": "questions", "page": 1},
+            {"op": "questions", "category": 1},
+            {"op": "quiz", "previous_questions": [], "count": 2},
+            {"op": "questions", "category": 1000},
+            {"op": "quiz", "quiz_category": {"type": "click", "id": 0}, "previous_questions": []},
+        ]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["results"][0], json.loads(self.client().get("/questions").data))
+        self.assertEqual(data["results"][1], json.loads(self.client().get("/categories/1/questions").data))
+        self.assertEqual(len(data["results"][2]["questions"]), 2)
+        self.assertEqual(data["results"][3]["error"], 404)
+        self.assertEqual(data["results"][4]["success"], True)
+
+    def test_400_batch_without_operations(self):
+        res = self.client().post("/batch", json={"operations": []})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_get_startup_timings(self):
+        res = self.client().get("/metrics/startup")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual([phase["name"] for phase in data["phases"]], ["config", "database", "components", "routes"])
+        self.assertTrue(data["first_request"])
+
+    def test_write_pipeline_create_and_delete(self):
+        app = create_app({"WRITE_PIPELINE": True})
+        setup_db(app, self.database_path)
+        res = app.test_client().post("/questions", json=self.new_question)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["question"]["question"], self.new_question["question"])
+
+        res = app.test_client().delete("/questions/{}".format(data["created"]))
+        self.assertEqual(res.status_code, 200)
+        res = app.test_client().delete("/questions/{}".format(data["created"]))
+        self.assertEqual(res.status_code, 422)
+
+    def test_search_follows_writes_of_other_workers(self):
+        other = create_app()
+        setup_db(other, self.database_path)
+        self.client().post("/questions", json={"searchTerm": "zebra"})
+        res = other.test_client().post("/questions", json={"question": "Which zebra?", "answer": "Grevy's", "difficulty": 1, "category": 1})
+        created = json.loads(res.data)["created"]
+
+        res = self.client().post("/questions", json={"searchTerm": "zebra"})
+        self.assertIn(created, [question["id"] for question in json.loads(res.data)["questions"]])
+        other.test_client().delete("/questions/{}".format(created))
+
+    def test_async_get_questions_matches_wsgi(self):
+        urls = ("/questions", "/questions?page=2", "/questions?after_id=5")
+        responses = self.async_responses([("GET", url, None) for url in urls])
+        for url, (status, data) in zip(urls, responses):
+            self.assertEqual(status, 200)
+            self.assertEqual(data, json.loads(self.client().get(url).data))
+
+    def test_async_search_matches_wsgi(self):
+        terms = ("title", "test2")
+        responses = self.async_responses([("POST", "/questions", {"searchTerm": term}) for term in terms])
+        for term, (status, data) in zip(terms, responses):
+            self.assertEqual(status, 200)
+            self.assertEqual(data, json.loads(self.client().post("/questions", json={"searchTerm": term}).data))
+
+    def test_async_quiz_matches_wsgi(self):
+        ids = [question["id"] for question in json.loads(self.client().get("/categories/1/questions").data)["questions"]]
+        quiz = {"quiz_category": {"type": "Science", "id": 1}, "previous_questions": ids[1:]}
+        [(status, data)] = self.async_responses([("POST", "/quizzes", quiz)])
+        self.assertEqual(status, 200)
+        self.assertEqual(data, json.loads(self.client().post("/quizzes", json=quiz).data))
+        self.assertEqual(data["question"]["id"], ids[0])
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file